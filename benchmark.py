@@ -0,0 +1,332 @@
+import time
+import argparse
+import numpy as np
+
+from utils.env_fn import *
+from utils.model import heuristic_agent, default_params, random_stream
+from utils.feature_fn import get_feature_counts, get_features, feature_names, n_subsets
+
+## pass the hyperparams
+parser = argparse.ArgumentParser(description='Micro-benchmarks of the environment')
+parser.add_argument('--mode', '-m', help='the benchmark to run', type=str, default='lines')
+parser.add_argument('--n_games', '-n', help='number of random games to sample positions from', type=int, default=200)
+parser.add_argument('--seed', '-s', help='random seed', type=int, default=2025)
+parser.add_argument('--depth', '-d', help='the depth of perft', type=int, default=3)
+parser.add_argument('--index', help='perft from the positions of a position index (its name prefix), '
+                    '"dataset" for the idx2state store, random games if empty', type=str, default='')
+
+# ---------------- positions ---------------- #
+
+def sample_positions(n_games, seed):
+    '''Sample (state, last action) pairs from random games'''
+    rng = np.random.default_rng(seed)
+    env = four_in_a_row()
+    positions = []
+    for _ in range(n_games):
+        state, done = env.reset(), False
+        while not done:
+            actions = env.get_valid_actions(state[0])
+            action = actions[rng.integers(len(actions))]
+            state, _, done, _ = env.transit(state, action)
+            positions.append((state, action))
+    return positions
+
+def timeit(fn, inputs, n_repeats=3):
+    '''Best per-call time in microseconds'''
+    best = np.inf
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        for x in inputs: fn(*x)
+        best = min(best, (time.perf_counter()-start)/len(inputs))
+    return best*1e6
+
+# ---------------- loop baselines ---------------- #
+
+def loop_check_win(board, not_occupied=-1):
+    '''The cell-by-cell win check, kept as the baseline'''
+    rows, cols = board.shape
+    for i in range(rows):
+        for j in range(cols-3):
+            q1 = board[i, j]!=not_occupied
+            q2 = board[i, j]==board[i, j+1]==board[i, j+2]==board[i, j+3]
+            if q1 and q2: return True
+    for i in range(rows-3):
+        for j in range(cols):
+            q1 = board[i, j]!=not_occupied
+            q2 = board[i, j]==board[i+1, j]==board[i+2, j]==board[i+3, j]
+            if q1 and q2: return True
+    for i in range(rows-3):
+        for j in range(cols-3):
+            q1 = board[i, j]!=not_occupied
+            q2 = board[i, j]==board[i+1, j+1]==board[i+2, j+2]==board[i+3, j+3]
+            if q1 and q2: return True
+    for i in range(rows-3):
+        for j in range(3, cols):
+            q1 = board[i, j]!=not_occupied
+            q2 = board[i, j]==board[i+1, j-1]==board[i+2, j-2]==board[i+3, j-3]
+            if q1 and q2: return True
+    return False
+
+def loop_check_win_action(board, action, player_id=0):
+    '''The direction-walking win check, kept as the baseline'''
+    rows, cols = board.shape
+    x, y = action
+    walks = [[(x, c) for c in range(max(0, y-3), min(cols, y+4))],
+             [(r, y) for r in range(max(0, x-3), min(rows, x+4))],
+             [(x+i, y+i) for i in range(-3, 4)],
+             [(x+i, y-i) for i in range(-3, 4)]]
+    for walk in walks:
+        count = 0
+        for r, c in walk:
+            if not (0<=r<rows and 0<=c<cols): continue
+            if board[r, c]==player_id:
+                count += 1
+                if count >= 4: return True
+            else:
+                count = 0
+    return False
+
+# ---------------- benchmarks ---------------- #
+
+def bench_lines(positions):
+    '''Win checks: cell loops vs the precomputed line index'''
+    boards = [(state[0],) for state, _ in positions]
+    moves = [(state[0], action, 1-state[1]) for state, action in positions]
+
+    # the line index must reproduce the loops
+    for board, in boards:
+        assert loop_check_win(board)==four_in_a_row.check_win(board)
+    for board, action, player_id in moves:
+        assert loop_check_win_action(board, action, player_id)==\
+                four_in_a_row.check_win_action(board, action, player_id)
+
+    print(f'{len(positions)} positions')
+    print(f'{"function":<20}{"loops (us)":>12}{"lines (us)":>12}{"speedup":>10}')
+    for name, loop_fn, line_fn, inputs in [
+        ('check_win', loop_check_win, four_in_a_row.check_win, boards),
+        ('check_win_action', loop_check_win_action, four_in_a_row.check_win_action, moves)]:
+        t_loop, t_line = timeit(loop_fn, inputs), timeit(line_fn, inputs)
+        print(f'{name:<20}{t_loop:>12.2f}{t_line:>12.2f}{t_loop/t_line:>9.1f}x')
+
+def bench_transit(positions, batch_size=4096):
+    '''Stepping many games: transit per state vs transit_batch'''
+    env = four_in_a_row()
+    rng = np.random.default_rng(0)
+    states = [state for state, _ in positions if len(env.get_valid_actions(state[0]))]
+    states = [states[i] for i in rng.integers(len(states), size=batch_size)]
+    actions = [env.get_valid_actions(s[0])[0] for s in states]
+    boards = np.stack([s[0] for s in states])
+    players = np.array([s[1] for s in states])
+    action_idx = np.array([env.action2idx(a) for a in actions])
+
+    t_loop = timeit(env.transit, list(zip(states, actions)))
+    t_batch = timeit(env.transit_batch, [(boards, players, action_idx)])/batch_size
+    print(f'{batch_size} games')
+    print(f'{"function":<20}{"per game (us)":>15}')
+    print(f'{"transit":<20}{t_loop:>15.2f}')
+    print(f'{"transit_batch":<20}{t_batch:>15.2f}')
+    print(f'speedup: {t_loop/t_batch:.1f}x')
+
+def dataset_states(index):
+    '''The states of the dataset, of a position index or of
+    the idx2state store (see data_fn.state_store)'''
+    from utils.data_fn import state_store, position_index
+    store = state_store.load() if index=='dataset' else position_index(index).store()
+    return [(board, int(player)) for board, player in zip(store.boards, store.players)]
+
+def bench_perft(positions, depth, n_positions=20, index=''):
+    '''Game tree counts and nodes/sec of each engine
+
+    From the empty board and from positions that are not
+    over, the engines must count the same tree. The positions
+    are sampled from the dataset if index is given (see
+    dataset_states), from random games otherwise.
+    '''
+    rng = np.random.default_rng(0)
+    states = dataset_states(index) if index else [state for state, _ in positions]
+    states = [state for state in states if len(four_in_a_row.get_valid_actions(state[0])) and
+              not four_in_a_row.check_win(state[0])]
+    states = [four_in_a_row().reset()]+[states[i] for i in rng.integers(len(states), size=n_positions)]
+    engines = [
+        ('transit', lambda state: four_in_a_row().perft(state, depth)),
+        ('bitboard', lambda state: bitboard_four_in_a_row().perft(state, depth)),
+        ('search_position', lambda state: search_position(state).perft(depth)),
+        ('transit_batch', lambda state: four_in_a_row.perft_batch(state, depth))]
+
+    source = f'positions of {index}' if index else 'random-game positions'
+    print(f'perft({depth}) from the empty board and {n_positions} {source}')
+    print(f'{"engine":<20}{"nodes":>10}{"wins":>8}{"draws":>8}{"nodes/sec":>12}')
+    ref_counts = None
+    for name, perft_fn in engines:
+        start = time.perf_counter()
+        counts = np.array([perft_fn(state) for state in states])
+        elapsed = time.perf_counter()-start
+        # the counts must match the reference engine exactly
+        if ref_counts is None: ref_counts = counts
+        assert np.array_equal(counts, ref_counts), f'{name} does not match transit'
+        nodes, wins, draws = counts.sum(axis=0)
+        print(f'{name:<20}{nodes:>10}{wins:>8}{draws:>8}{nodes/elapsed:>12.0f}')
+
+def bench_threats(positions):
+    '''Winning cells: check_win_action per empty cell vs the threat masks'''
+    def loop_threats(board):
+        empty = [four_in_a_row.idx2action(i) for i in 
+                 np.flatnonzero(board==four_in_a_row.not_occupied)]
+        threats = []
+        for player_id in [0, 1]:
+            cells = []
+            for action in empty:
+                board[action] = player_id
+                if four_in_a_row.check_win_action(board, action, player_id): cells.append(action)
+                board[action] = four_in_a_row.not_occupied
+            threats.append(cells)
+        return tuple(threats)
+    def mask_threats(black, white):
+        empty = bitboard_four_in_a_row.full_mask ^ (black | white)
+        return (bitboard_four_in_a_row.threats(black, empty),
+                bitboard_four_in_a_row.threats(white, empty))
+
+    boards = [(state[0].copy(),) for state, _ in positions]
+    bits = [bitboard_four_in_a_row.board2bits(board) for board, in boards]
+    for (board,) in boards:
+        assert loop_threats(board)==four_in_a_row.get_threats(board)
+
+    print(f'{len(positions)} positions')
+    print(f'{"function":<20}{"per call (us)":>15}{"speedup":>10}')
+    t_loop = None
+    for name, fn, inputs in [('check_win_action', loop_threats, boards),
+                             ('get_threats', four_in_a_row.get_threats, boards),
+                             ('threats (masks)', mask_threats, bits)]:
+        t = timeit(fn, inputs)
+        if t_loop is None: t_loop = t
+        print(f'{name:<20}{t:>15.2f}{t_loop/t:>9.1f}x')
+
+def bench_features(positions):
+    '''Heuristic pattern counts: the loops vs the vectorized extractor'''
+    def loop_counts(board):
+        for player_id in [0, 1]:
+            pieces = np.vstack(np.where(board==player_id)).T
+            for name in feature_names:
+                getattr(heuristic_agent, f'get_{name}')(board, pieces)
+    boards = np.stack([state[0] for state, _ in positions])
+    t_loop = timeit(loop_counts, [(board,) for board in boards])
+    t_vec = timeit(get_feature_counts, [(boards,)])/len(boards)
+    print(f'{len(boards)} boards, both players, four features')
+    print(f'{"function":<20}{"per board (us)":>16}')
+    print(f'{"loops":<20}{t_loop:>16.2f}')
+    print(f'{"get_feature_counts":<20}{t_vec:>16.2f}')
+    print(f'speedup: {t_loop/t_vec:.1f}x')
+
+def bench_dropout(positions, batch_size=30):
+    '''Feature dropout: the cost of a random subset of the features
+
+    The values of batches of children, about the branching 
+    of the search, from the same raw features, with all the
+    features and with a random subset per batch; and the 
+    weights of a subset, selected by its bitmask or masked
+    by the feature names as before.
+    '''
+    agent = heuristic_agent(four_in_a_row(), default_params().to_list())
+    agent.player_id, agent.opponent_id = 0, 1
+    boards = np.stack([state[0] for state, _ in positions])
+    features = get_features(boards)
+    batches = [features[i:i+batch_size] for i in range(0, len(features)-batch_size+1, batch_size)]
+    subsets = np.random.default_rng(0).integers(n_subsets, size=len(batches))
+    names = [agent.features for agent.subset in subsets]
+    base_weights = np.array([agent.w_ce, agent.w_c2, agent.w_u2, agent.w_c3, agent.w_c4])
+
+    def evaluate(batch, subset):
+        agent.subset = subset
+        return agent.heuristic_many(None, 0, batch)
+    def subset_weights(subset):
+        return agent.subset_weights[subset]
+    def name_weights(features):
+        weights = base_weights.copy()
+        weights[1:] *= np.isin(feature_names, features)
+        return weights
+
+    # the subsets share the raw features
+    for batch, subset, features in zip(batches, subsets, names):
+        agent.seed(0)
+        values = evaluate(batch, subset)
+        agent.subset = n_subsets-1
+        agent.features = features
+        agent.seed(0)
+        assert np.array_equal(values, agent.heuristic_many(None, 0, batch))
+
+    print(f'{len(batches)} batches of {batch_size} children, cached raw features')
+    print(f'{"function":<24}{"per node (us)":>15}')
+    for name, fn, inputs in [
+        ('all features', evaluate, [(batch, n_subsets-1) for batch in batches]),
+        ('random subset', evaluate, list(zip(batches, subsets))),
+        ('weights: bitmask', subset_weights, [(subset,) for subset in subsets]),
+        ('weights: names', name_weights, [(n,) for n in names])]:
+        print(f'{name:<24}{timeit(fn, inputs)/batch_size:>15.3f}')
+
+class global_stream(random_stream):
+    '''The draws of the global numpy RNG, as the agents made
+    them before random_stream, seeded once per call'''
+    def __init__(self, seed=0): self.seed, self.n_calls = seed, 0
+    def reset(self, trial=None): pass
+    def trial_seeds(self, n): 
+        np.random.seed(self.seed+self.n_calls)
+        self.n_calls += 1
+        return [None]*n
+    def normal(self, n=None): return np.random.randn() if n is None else np.random.randn(n)
+    def uniform(self, n=None): return np.random.rand() if n is None else np.random.rand(n)
+
+def bench_rng(positions, n_trials=300):
+    '''The random streams of the trials: response_generator
+    with a random_stream per agent vs the global RNG
+
+    The design indexes the sampled positions instead of the
+    dataset. The draws alone are timed as a heuristic_agent
+    trial makes them: the root, then its children at once.
+    '''
+    states = [state for state, _ in positions if len(four_in_a_row.get_valid_actions(state[0]))>0]
+    states = [states[i] for i in np.random.default_rng(0).integers(len(states), size=n_trials)]
+    boards, players = np.stack([s[0] for s in states]), np.array([s[1] for s in states])
+    features = get_features(boards)
+    class sampled_env(four_in_a_row):
+        def embed_many(self, idx): return boards[idx], players[idx]
+        def embed_features(self, idx): return features[idx]
+    env, params, design = sampled_env(), default_params().to_list(), np.arange(n_trials)
+
+    def draws(rng):
+        for seed in rng.trial_seeds(n_trials):
+            rng.reset(seed)
+            rng.normal(1), rng.normal(35)
+
+    print(f'{n_trials} trials, new draws in each call')
+    print(f'{"function":<32}{"per trial (us)":>16}')
+    for name in ['draws', 'heuristic_agent']:
+        for stream in [random_stream(0), global_stream(0)]:
+            if name=='draws': fn, inputs = draws, [(stream,)]
+            else: 
+                # an agent per stream, each with its own feature cache
+                agent = heuristic_agent(env, params, seed=stream)
+                fn, inputs = agent.response_generator, [(params, design)]
+            label = f'{name} ({type(stream).__name__})'
+            print(f'{label:<32}{timeit(fn, inputs)/n_trials:>16.2f}')
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    positions = sample_positions(args.n_games, args.seed)
+
+    if args.mode == 'lines':
+        bench_lines(positions)
+    elif args.mode == 'transit':
+        bench_transit(positions)
+    elif args.mode == 'threats':
+        bench_threats(positions)
+    elif args.mode == 'features':
+        bench_features(positions)
+    elif args.mode == 'perft':
+        bench_perft(positions, args.depth, index=args.index)
+    elif args.mode == 'dropout':
+        bench_dropout(positions)
+    elif args.mode == 'rng':
+        bench_rng(positions)
+    else:
+        raise ValueError('Invalid mode')
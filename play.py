@@ -6,6 +6,7 @@ import pandas as pd
 
 from utils.env_fn import *
 from utils.model import *
+from utils.data_fn import game_log
 from utils.fig_fn import *
 
 ## pass the hyperparams
@@ -24,10 +25,13 @@ def human_vs_human(collect_data=True, white_player='', black_player='', block_id
 
     env = game_fn()
     if collect_data:
-        # initialize a dict for game data collection 
-        columns = ['board', 'play_to_move', 'action', 'done', 
+        # the moves go to the binary game log, the boards 
+        # are rebuilt from it; the csv keeps the timing
+        log = game_log(f"{pth}/data/human_vs_human/Human_vs_Human_games.fiar")
+        columns = ['play_to_move', 'action', 'done', 
                    'winner', 'trial', 'time_elapsed', 'rt']
         game_data = {c: [] for c in columns}
+        moves = []
         block_id = int(block_id)
      
     # start the game 
@@ -53,13 +57,14 @@ def human_vs_human(collect_data=True, white_player='', black_player='', block_id
                 grid_y = pos_x // env.cell_size  # Column
                 # Find the first available row from bottom
                 action = (grid_x-1, grid_y-1)
+                # clicks on the margins are not cells
+                if not (0<=action[0]<env.rows and 0<=action[1]<env.cols): continue
                 next_state, reward, done, info = env.step(action)
                 response_time = time.time()
 
                 # collect data 
                 if collect_data:
                     board, player_to_move = state
-                    game_data['board'].append(board2layout(board))
                     game_data['play_to_move'].append(player_to_move)
                     game_data['action'].append(str(action))
                     game_data['done'].append(done)
@@ -70,6 +75,8 @@ def human_vs_human(collect_data=True, white_player='', black_player='', block_id
                     game_data['time_elapsed'].append(elasped_seconds)
                     rt = response_time - state_present_time
                     game_data['rt'].append(rt)
+                    # clicks on occupied cells are not moves
+                    if next_state is not state: moves.append(action)
 
                 # update the trial and state 
                 state_present_time = response_time
@@ -82,6 +89,8 @@ def human_vs_human(collect_data=True, white_player='', black_player='', block_id
                         fname = f"{pth}/data/human_vs_human/Human_vs_Human_data"
                         fname += f"-white={white_player}-black={black_player}-block={block_id}.csv"
                         pd.DataFrame(game_data).to_csv(fname, index=False)
+                        log.append(moves)
+                        moves = []
                         block_id += 1
                     
                     # restart the game 
@@ -146,6 +155,8 @@ def human_vs_ai():
                 grid_y = pos_x // env.cell_size   # Column
                 # Find the first available row from bottom
                 action = (grid_x-1, grid_y-1)
+                # clicks on the margins are not cells
+                if not (0<=action[0]<env.rows and 0<=action[1]<env.cols): continue
                 state, reward, done, info = env.step(action)
                 if done:
                     env.render(mode='game')
@@ -0,0 +1,101 @@
+import os
+import time
+import argparse
+import numpy as np
+
+from utils.env_fn import *
+from utils.model import *
+from utils.data_fn import game_log
+from utils.parallel import get_pool
+
+## pass the hyperparams
+parser = argparse.ArgumentParser(description='Headless self-play between two agents')
+parser.add_argument('--black_agent', '-b', help='the agent playing black', type=str, default='heuristic_agent')
+parser.add_argument('--white_agent', '-w', help='the agent playing white', type=str, default='heuristic_agent')
+parser.add_argument('--black_params', help='comma separated params of black, default params if empty', type=str, default='')
+parser.add_argument('--white_params', help='comma separated params of white, default params if empty', type=str, default='')
+parser.add_argument('--n_games', '-n', help='number of games', type=int, default=1000)
+parser.add_argument('--n_shards', help='number of game logs, defaults to n_cores', type=int, default=0)
+parser.add_argument('--n_cores', '-c', help='number of CPU cores, 70%% of the cores if 0', type=int, default=0)
+parser.add_argument('--name', help='the prefix of the game logs', type=str, default='')
+parser.add_argument('--seed', '-s', help='random seed', type=int, default=2025)
+
+# find the current path
+pth = os.path.dirname(os.path.abspath(__file__))
+
+def parse_params(params):
+    '''The params from the command line, default params if empty'''
+    if params=='': return default_params().to_list()
+    return [float(p) for p in params.split(',')]
+
+def play_games(black, white, game_ids, fname, seed):
+    '''Play a shard of games and append them to a game log
+
+    Each game has its own seed sequence, from seed and the 
+    game id, and each agent an independent stream spawned 
+    from it (see model.random_stream), so the games do not 
+    depend on how they are split across shards and processes.
+
+    Inputs:
+        black (tuple): (agent name, params) of the black player
+        white (tuple): (agent name, params) of the white player
+        game_ids (list): the ids of the games to play
+        fname (str): the game log of the shard
+        seed (int): the random seed of the run
+
+    Outputs:
+        n_games (int): the number of games played
+        n_moves (int): the number of moves played
+        winners (np.ndarray): the number of black wins,
+            white wins and draws
+    '''
+    env = four_in_a_row()
+    agents = [eval(name)(deepcopy(env), params=params) for name, params in [black, white]]
+    log = game_log(fname)
+    n_moves, winners = 0, np.zeros(3, dtype=int)
+    for game_id in game_ids:
+        for agent, seed_seq in zip(agents, np.random.SeedSequence([seed, game_id]).spawn(2)):
+            agent.seed(seed_seq)
+        state, done, actions = env.reset(), False, []
+        while not done:
+            action = agents[state[1]].get_action(state)
+            action = (int(action[0]), int(action[1]))
+            state, _, done, info = env.step(action)
+            actions.append(action)
+        log.append(actions)
+        n_moves += len(actions)
+        winners[{'black': 0, 'white': 1}.get(info.get('winner'), 2)] += 1
+    return len(game_ids), n_moves, winners
+
+def self_play(args):
+    '''Play the games on a process pool, one game log per shard'''
+    black = (args.black_agent, parse_params(args.black_params))
+    white = (args.white_agent, parse_params(args.white_params))
+    name = args.name if args.name else f'{args.black_agent}_vs_{args.white_agent}'
+    pool = get_pool(args)
+    n_shards = args.n_shards if args.n_shards else pool._processes
+    os.makedirs(f'{pth}/data/self_play', exist_ok=True)
+    shards = np.array_split(np.arange(args.n_games), n_shards)
+    tasks = [(black, white, game_ids.tolist(),
+              f'{pth}/data/self_play/{name}-shard={k}.fiar', args.seed)
+             for k, game_ids in enumerate(shards) if len(game_ids)]
+
+    start = time.perf_counter()
+    n_games, n_moves, winners = 0, 0, np.zeros(3, dtype=int)
+    for shard_games, shard_moves, shard_winners in pool.starmap(play_games, tasks):
+        n_games += shard_games
+        n_moves += shard_moves
+        winners += shard_winners
+    elapsed = time.perf_counter()-start
+    pool.close()
+    pool.join()
+
+    print(f'{n_games} games in {len(tasks)} shards, {elapsed:.1f}s')
+    print(f'black wins: {winners[0]}, white wins: {winners[1]}, draws: {winners[2]}')
+    print(f'{n_games/elapsed:.2f} games/sec, {n_moves/elapsed:.1f} moves/sec')
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    self_play(args)
@@ -0,0 +1,768 @@
+import os
+import json
+import pickle
+import hashlib
+import sqlite3
+import numpy as np
+import pandas as pd
+from .env_fn import four_in_a_row, search_position
+from .feature_fn import get_features
+
+pth = os.path.dirname(os.path.abspath(__file__))
+data_pth = f'{pth}/../data'
+
+# ---------------- State store ---------------- #
+
+class state_store:
+    '''Read-only memory-mapped store of the dataset states
+
+    The idx2state pickle maps each state_idx to a design
+    vector (the flattened board followed by the player to
+    move). The store converts it once to a contiguous int8
+    array on disk, one row of rows*cols+1 values per state,
+    and memory-maps it read-only.
+
+    The mapping is opened once per process (see load) and
+    the pages are shared by the OS between the processes
+    that map the same file, so the workers of a pool do
+    not each hold their own copy. Pickling a store (e.g.
+    to send an agent to a worker) only sends the file name.
+
+    Inputs:
+        fname (str): the .npy file of the store, or a raw .bin 
+            file of int8 rows (see position_index)
+    '''
+    _stores = {}
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.size = os.path.getsize(fname)
+        n_cells = four_in_a_row.rows*four_in_a_row.cols
+        # a plain ndarray view of the read-only mapping
+        if fname.endswith('.bin') and self.size==0:
+            self.data = np.zeros([0, n_cells+1], dtype=four_in_a_row.board_dtype)
+        elif fname.endswith('.bin'):
+            self.data = np.asarray(np.memmap(fname, dtype=four_in_a_row.board_dtype, 
+                                             mode='r').reshape([-1, n_cells+1]))
+        else:
+            self.data = np.asarray(np.load(fname, mmap_mode='r'))
+        self.boards = self.data[:, :n_cells].reshape([-1, four_in_a_row.rows, four_in_a_row.cols])
+        self.players = self.data[:, n_cells]
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __reduce__(self):
+        # reopen, or reuse, the mapping in the receiving process
+        return (state_store.open, (self.fname,))
+
+    @staticmethod
+    def open(fname):
+        '''Open the mapping of fname, once per process
+
+        The file is mapped again when it has grown, e.g. 
+        after new positions were indexed.
+        '''
+        fname = os.path.abspath(fname)
+        if fname not in state_store._stores or \
+                state_store._stores[fname].size!=os.path.getsize(fname):
+            state_store._stores[fname] = state_store(fname)
+        return state_store._stores[fname]
+
+    @staticmethod
+    def build(src_fname, fname):
+        '''Convert an idx2state pickle to the store format
+
+        Inputs:
+            src_fname (str): the idx2state pickle, a dict or a
+                sequence mapping state_idx to a design vector
+            fname (str): the .npy file to write
+        '''
+        with open(src_fname, 'rb') as f: idx2state = pickle.load(f)
+        if not isinstance(idx2state, dict):
+            idx2state = dict(enumerate(idx2state))
+        n_cells = four_in_a_row.rows*four_in_a_row.cols
+        # state indices missing from the pickle are empty
+        # boards with player -1
+        data = np.full([max(idx2state.keys())+1, n_cells+1],
+                       four_in_a_row.not_occupied, dtype=four_in_a_row.board_dtype)
+        for state_idx, design in idx2state.items():
+            design = np.asarray(design)
+            data[state_idx, :n_cells] = four_in_a_row.encode(design[:n_cells])
+            data[state_idx, n_cells] = int(design[n_cells])
+        # write then rename, so readers never see a partial file
+        tmp_fname = f'{fname}.{os.getpid()}.tmp'
+        with open(tmp_fname, 'wb') as f: np.save(f, data)
+        os.replace(tmp_fname, fname)
+
+    @staticmethod
+    def load(fname=f'{data_pth}/human_vs_human-idx2state.npy',
+             src_fname=f'{data_pth}/human_vs_human-idx2state.pkl'):
+        '''Open the store, once per process
+
+        The store is (re)built from src_fname when the .npy
+        file is missing or older than the pickle.
+        '''
+        if os.path.abspath(fname) not in state_store._stores:
+            if os.path.exists(src_fname) and (not os.path.exists(fname) or
+                    os.path.getmtime(fname) < os.path.getmtime(src_fname)):
+                state_store.build(src_fname, fname)
+        return state_store.open(fname)
+
+    def embed(self, state_idx):
+        '''The state of one state_idx, the board is a view of the mapping'''
+        return (self.boards[state_idx], int(self.players[state_idx]))
+
+    def embed_many(self, idx_array):
+        '''The states of a batch of state indices
+
+        A contiguous range of indices (a slice) returns views
+        of the mapping, an index array gathers the rows into
+        one int8 array.
+
+        Inputs:
+            idx_array (np.ndarray or slice): the state indices
+
+        Outputs:
+            boards (np.ndarray): (N, rows, cols) int8 boards
+            players (np.ndarray): (N,) the player to move
+        '''
+        return self.boards[idx_array], self.players[idx_array]
+
+# ---------------- Dataset ---------------- #
+
+# the files of the state store and of the feature table of the
+# state indices of the fits (see four_in_a_row.embed), the 
+# idx2state store and its table if None
+dataset = {'store': None, 'features': None}
+
+def use_dataset(store=None, features=None):
+    '''Set the dataset read by four_in_a_row.embed, embed_many 
+    and embed_features, in this process and in the processes
+    forked from it
+
+    The files are reopened when they grow, and the feature 
+    table is extended to the new states of the store.
+
+    Inputs:
+        store (state_store or str): the states, e.g. 
+            position_index.store(), the idx2state store if None
+        features (feature_table or str): the features of the 
+            states, e.g. position_index.features(), next to
+            the store if None
+    '''
+    if isinstance(store, state_store): store = store.fname
+    if isinstance(features, feature_table): features = features.fname
+    if store is not None and features is None: 
+        features = f'{os.path.splitext(store)[0]}-features.bin'
+    dataset['store'], dataset['features'] = store, features
+
+def dataset_store():
+    '''The state store of the fits, see use_dataset'''
+    if dataset['store'] is None: return state_store.load()
+    return state_store.open(dataset['store'])
+
+def dataset_features():
+    '''The feature table of the fits, see use_dataset'''
+    if dataset['store'] is None: return feature_table.load()
+    return feature_table.load(dataset['features'], dataset_store())
+
+# ---------------- Feature table ---------------- #
+
+class feature_table:
+    '''Read-only memory-mapped raw features of the dataset states
+
+    One float64 row per state_idx of a state store, the raw
+    heuristic features of both players (see feature_fn.get_features),
+    so that the features of the root positions of a fit are 
+    read instead of computed. Rows are only appended: when 
+    the store grows (see position_index), build computes the
+    features of the new states only.
+
+    Inputs:
+        fname (str): the raw .bin file of the table
+    '''
+    _tables = {}
+    shape = (2, 5)
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.size = os.path.getsize(fname)
+        n_rows = self.size//(8*np.prod(self.shape))
+        if n_rows==0:
+            self.data = np.zeros([0, *self.shape])
+        else:
+            # whole rows only, a row being appended is not read
+            self.data = np.asarray(np.memmap(fname, dtype=np.float64, mode='r', 
+                                             shape=(n_rows, *self.shape)))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __reduce__(self):
+        return (feature_table.open, (self.fname,))
+
+    def __getitem__(self, idx_array):
+        '''The (N, 2, 5) features of a batch of state indices'''
+        return self.data[idx_array]
+
+    @staticmethod
+    def open(fname):
+        '''Open the mapping of fname, once per process, and
+        again when the file has grown'''
+        fname = os.path.abspath(fname)
+        if fname not in feature_table._tables or \
+                feature_table._tables[fname].size!=os.path.getsize(fname):
+            feature_table._tables[fname] = feature_table(fname)
+        return feature_table._tables[fname]
+
+    @staticmethod
+    def build(store, fname, batch_size=4096):
+        '''Compute the features of the states missing from the table
+
+        Inputs:
+            store (state_store): the states, the table is aligned
+                with their state_idx
+            fname (str): the .bin file of the table; a table 
+                older than an .npy store is rebuilt, since the
+                store was rewritten
+            batch_size (int): the states computed at once
+        '''
+        row_size = 8*int(np.prod(feature_table.shape))
+        start = 0
+        if os.path.exists(fname) and not (store.fname.endswith('.npy') and
+                os.path.getmtime(fname)<os.path.getmtime(store.fname)):
+            start = os.path.getsize(fname)//row_size
+        # a new table is written then renamed, rows are appended 
+        # to an existing one, readers never see a partial row
+        out_fname = fname if start else f'{fname}.{os.getpid()}.tmp'
+        with open(out_fname, 'r+b' if start else 'wb') as f:
+            f.truncate(start*row_size)
+            f.seek(start*row_size)
+            for i in range(start, len(store), batch_size):
+                boards, _ = store.embed_many(slice(i, i+batch_size))
+                f.write(get_features(boards).astype(np.float64).tobytes())
+        if not start: os.replace(out_fname, fname)
+
+    @staticmethod
+    def load(fname=f'{data_pth}/human_vs_human-idx2state-features.bin', store=None):
+        '''Open the table, built or extended to cover the store
+
+        Inputs:
+            fname (str): the .bin file of the table
+            store (state_store): the states, the default store
+                if None (see state_store.load)
+        '''
+        if store is None: store = state_store.load()
+        table = feature_table.open(fname) if os.path.exists(fname) else None
+        if table is None or len(table)!=len(store) or (store.fname.endswith('.npy') and 
+                os.path.getmtime(fname)<os.path.getmtime(store.fname)):
+            feature_table.build(store, fname)
+        return feature_table.open(fname)
+
+# ---------------- Design matrices ---------------- #
+
+def read_sub_data(fname):
+    '''Read the trials of one subject, columnar
+
+    Only the state_idx and action columns are read.
+
+    Inputs:
+        fname (str): a csv file with one row per trial, in 
+            block order, or a pickle of the subject data 
+            {block_id: block_data}
+
+    Outputs:
+        sub_data (pd.DataFrame or dict): the subject data
+    '''
+    if fname.endswith('.csv'):
+        return pd.read_csv(fname, usecols=['state_idx', 'action'])
+    with open(fname, 'rb') as f: return pickle.load(f)
+
+def load_design_response(fname, cache_pth=f'{data_pth}/cache'):
+    '''The design and response matrices of one subject, cached
+
+    The matrices are saved as an .npz file in cache_pth along
+    with the modification time of the subject file, and are 
+    rebuilt when the subject file changes.
+
+    Inputs:
+        fname (str): the subject data, see read_sub_data
+        cache_pth (str): the folder of the cached matrices
+
+    Outputs:
+        design_matrix (np.ndarray): the state indices
+        response_matrix (np.ndarray): the action indices
+    '''
+    src_mtime = os.path.getmtime(fname)
+    path_id = hashlib.md5(os.path.abspath(fname).encode()).hexdigest()[:8]
+    name = os.path.splitext(os.path.basename(fname))[0]
+    cache_fname = f'{cache_pth}/{name}-{path_id}-design.npz'
+    if os.path.exists(cache_fname):
+        with np.load(cache_fname) as cache:
+            if cache['src_mtime']==src_mtime:
+                return cache['design_matrix'], cache['response_matrix']
+    design_matrix, response_matrix = \
+        four_in_a_row.get_design_response_mat(read_sub_data(fname))
+    # write then rename, so readers never see a partial file
+    os.makedirs(cache_pth, exist_ok=True)
+    tmp_fname = f'{cache_fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.savez(f, design_matrix=design_matrix, 
+                 response_matrix=response_matrix, 
+                 src_mtime=src_mtime)
+    os.replace(tmp_fname, cache_fname)
+    return design_matrix, response_matrix
+
+# ---------------- Game log ---------------- #
+
+class game_log:
+    '''Append-only binary log of games
+
+    The file starts with a header (the magic bytes, the 
+    format version and the board shape), followed by one
+    record per game: the number of plies as a uint8, then
+    the action index (row*cols+col) of each ply as a uint8.
+    The boards, the players to move and the outcome are 
+    rebuilt on demand by replaying the moves.
+
+    A game is written by a single write call, so a reader
+    never sees a partial record unless the writer crashed,
+    in which case the incomplete tail is ignored.
+
+    Inputs:
+        fname (str): the log file, created if missing
+    '''
+    magic = b'FIAR'
+    version = 1
+    start = (np.full([four_in_a_row.rows, four_in_a_row.cols], 
+                     four_in_a_row.not_occupied, dtype=four_in_a_row.board_dtype),
+             four_in_a_row.player1_color)
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.header = self.magic+bytes([self.version, 
+                        four_in_a_row.rows, four_in_a_row.cols])
+        if not os.path.exists(fname) or os.path.getsize(fname)==0:
+            with open(fname, 'wb') as f: f.write(self.header)
+        else:
+            with open(fname, 'rb') as f: header = f.read(len(self.header))
+            if header!=self.header:
+                raise ValueError(f'{fname} is not a game log of this board')
+
+    def append(self, actions):
+        '''Append one game
+
+        Inputs:
+            actions (list): the actions of the game, in order, 
+                as (row, col) tuples or action indices
+        '''
+        moves = [a if np.isscalar(a) else four_in_a_row.action2idx(a)
+                 for a in actions]
+        # the game must be legal, checked by replaying it
+        position = search_position(game_log.start)
+        for idx in moves:
+            action = four_in_a_row.idx2action(int(idx))
+            if action not in position.get_valid_actions():
+                raise ValueError(f'Invalid action {action}')
+            position.push(action)
+        record = np.array([len(moves)]+list(moves), dtype=np.uint8).tobytes()
+        with open(self.fname, 'ab') as f: f.write(record)
+
+    def games(self):
+        '''Stream the games of the log
+
+        Outputs:
+            moves (np.ndarray): the uint8 action indices of 
+                each game, one game at a time
+        '''
+        for _, moves in self.records():
+            yield moves
+
+    def records(self, offset=None):
+        '''Stream the games with their position in the file
+
+        Inputs:
+            offset (int): the file offset to start from, the 
+                end of a record returned earlier
+
+        Outputs:
+            end (int): the file offset after the game
+            moves (np.ndarray): the action indices of the game
+        '''
+        with open(self.fname, 'rb') as f:
+            f.seek(len(self.header) if offset is None else offset)
+            while True:
+                n = f.read(1)
+                if len(n)==0: return
+                moves = f.read(n[0])
+                if len(moves)<n[0]: return
+                yield f.tell(), np.frombuffer(moves, dtype=np.uint8)
+
+    def __iter__(self):
+        return self.games()
+
+    @staticmethod
+    def replay(moves):
+        '''Rebuild the positions of one game
+
+        Inputs:
+            moves (np.ndarray): the action indices of the game
+
+        Outputs:
+            state (tuple): (board, player_to_move) before each 
+                move, the board is an int8 copy
+            action (tuple): the action played in that state
+            done (bool): whether the action ends the game
+            winner (int): 0 black, 1 white, -1 draw or unfinished
+        '''
+        position = search_position(game_log.start)
+        for idx in moves:
+            action = four_in_a_row.idx2action(int(idx))
+            state = (position.board.copy(), position.curr_player)
+            position.push(action)
+            yield state, action, position.done, position.winner
+
+    def positions(self):
+        '''Stream the (state, action) pairs of all games'''
+        for moves in self.games():
+            for state, action, _, _ in self.replay(moves):
+                yield state, action
+
+    @staticmethod
+    def from_csv(csv_fnames, fname):
+        '''Convert the csv files of play.py to a log
+
+        The clicks on occupied cells, recorded as trials that
+        leave the board unchanged, are dropped, and a file
+        holding several games is split at the end of each.
+
+        Inputs:
+            csv_fnames (list): the csv files
+            fname (str): the log file to append to
+        '''
+        log = game_log(fname)
+        for csv_fname in csv_fnames:
+            actions = pd.read_csv(csv_fname, usecols=['action'])['action']
+            position, moves = search_position(game_log.start), []
+            for idx in four_in_a_row.parse_actions(actions):
+                action = four_in_a_row.idx2action(int(idx))
+                if action not in position.get_valid_actions(): continue
+                position.push(action)
+                moves.append(idx)
+                if position.done:
+                    log.append(moves)
+                    position, moves = search_position(game_log.start), []
+            if len(moves): log.append(moves)
+        return log
+
+# ---------------- Position index ---------------- #
+
+class position_index:
+    '''Incremental index of the positions of the game logs
+
+    Every position in which a move was played gets a stable
+    state_idx, the order of its first occurrence, and a count
+    of its occurrences. Positions are deduplicated by their 
+    Zobrist hash. The index is kept in append-only files:
+
+        * {name}-states.bin: one int8 row per state_idx, the
+            flat board followed by the player to move; it is
+            the state store of the dataset (see state_store)
+        * {name}-hashes.bin: the uint64 hash of each state
+        * {name}-counts.bin: the uint32 count of each state,
+            updated in place
+        * {name}-index.json: how far each log has been read
+        * {name}-features.bin: the raw features of each state,
+            built on demand (see features)
+
+    Adding games appends the new positions and increments 
+    the counts of the known ones, so the cost follows the 
+    number of new games and not the size of the index.
+
+    Inputs:
+        name (str): the prefix of the index files
+    '''
+    def __init__(self, name=f'{data_pth}/human_vs_human'):
+        self.states_fname = f'{name}-states.bin'
+        self.hashes_fname = f'{name}-hashes.bin'
+        self.counts_fname = f'{name}-counts.bin'
+        self.meta_fname = f'{name}-index.json'
+        self.features_fname = f'{name}-features.bin'
+        for fname in [self.states_fname, self.hashes_fname, self.counts_fname]:
+            if not os.path.exists(fname): open(fname, 'wb').close()
+        self._hash2idx = None
+        self.offsets = {}
+        if os.path.exists(self.meta_fname):
+            with open(self.meta_fname) as f: self.offsets = json.load(f)
+
+    def __len__(self):
+        return os.path.getsize(self.hashes_fname)//np.dtype(np.uint64).itemsize
+
+    @property
+    def hash2idx(self):
+        '''The state_idx of each hash, read from the hashes file
+        on first use (O(number of states)), so opening the index
+        to read the store or the features does not pay for it'''
+        if self._hash2idx is None:
+            hashes = np.fromfile(self.hashes_fname, dtype=np.uint64)
+            self._hash2idx = dict(zip(hashes.tolist(), range(len(hashes))))
+        return self._hash2idx
+
+    @property
+    def counts(self):
+        '''The number of occurrences of each state_idx'''
+        return np.fromfile(self.counts_fname, dtype=np.uint32)
+
+    def store(self):
+        '''The state store of the indexed positions'''
+        return state_store.open(self.states_fname)
+
+    def features(self):
+        '''The feature table of the indexed positions, extended 
+        to the positions indexed since the last call'''
+        return feature_table.load(self.features_fname, self.store())
+
+    def use(self):
+        '''Make the index the dataset of the fits, see use_dataset'''
+        use_dataset(self.states_fname, self.features_fname)
+
+    def lookup(self, state):
+        '''The state_idx of a state, -1 if it is not indexed'''
+        return self.hash2idx.get(four_in_a_row.zobrist_hash(state), -1)
+
+    def add_games(self, games):
+        '''Index the positions of new games
+
+        Inputs:
+            games (iterable): the action indices of each game
+
+        Outputs:
+            design_matrix (np.ndarray): the state_idx of each
+                position, in order of play
+            response_matrix (np.ndarray): the action played
+        '''
+        n_cells = four_in_a_row.rows*four_in_a_row.cols
+        design_matrix, response_matrix = [], []
+        new_rows, new_hashes = [], []
+        hash2idx = self.hash2idx
+        for moves in games:
+            position = search_position(game_log.start)
+            for idx in moves:
+                h = position.hash
+                state_idx = hash2idx.get(h)
+                if state_idx is None:
+                    state_idx = hash2idx[h] = len(hash2idx)
+                    new_rows.append(np.append(position.flat, position.curr_player))
+                    new_hashes.append(h)
+                design_matrix.append(state_idx)
+                response_matrix.append(int(idx))
+                position.push(four_in_a_row.idx2action(int(idx)))
+        design_matrix = np.array(design_matrix, dtype=np.int64)
+
+        # append the new states, then count all the positions
+        with open(self.states_fname, 'ab') as f:
+            f.write(np.array(new_rows, dtype=four_in_a_row.board_dtype).reshape([-1, n_cells+1]).tobytes())
+        with open(self.hashes_fname, 'ab') as f:
+            f.write(np.array(new_hashes, dtype=np.uint64).tobytes())
+        with open(self.counts_fname, 'ab') as f:
+            f.write(np.zeros(len(new_hashes), dtype=np.uint32).tobytes())
+        if len(design_matrix):
+            # only the touched pages of the counts are written
+            counts = np.memmap(self.counts_fname, dtype=np.uint32, mode='r+')
+            np.add.at(counts, design_matrix, 1)
+            counts.flush()
+            del counts
+        return design_matrix, np.array(response_matrix, dtype=np.int64)
+
+    def add_log(self, fname):
+        '''Index the games of a log not indexed yet
+
+        The log is read from where the previous call stopped.
+
+        Inputs:
+            fname (str): the game log
+
+        Outputs:
+            design_matrix (np.ndarray): the state_idx of each
+                new position, see add_games
+            response_matrix (np.ndarray): the action played
+        '''
+        key = os.path.abspath(fname)
+        end, games = self.offsets.get(key), []
+        for end, moves in game_log(fname).records(end):
+            games.append(moves)
+        design_matrix, response_matrix = self.add_games(games)
+        if end is not None:
+            self.offsets[key] = end
+            # write then rename, so readers never see a partial file
+            tmp_fname = f'{self.meta_fname}.{os.getpid()}.tmp'
+            with open(tmp_fname, 'w') as f: json.dump(self.offsets, f, indent=1)
+            os.replace(tmp_fname, self.meta_fname)
+        return design_matrix, response_matrix
+
+# ---------------- Endgame table ---------------- #
+
+class endgame_table:
+    '''Read-only memory-mapped table of solved endgames
+
+    The exact values of the positions with at most max_empty
+    empty cells, for the player to move: 1 win, 0 draw and 
+    -1 loss. The table is an open-addressing hash table of
+    (canonical hash, value) slots, at most half full, indexed
+    by the low bits of the hash and probed linearly; a zero
+    hash marks an empty slot (0 is the hash of the empty 
+    board, never in the table). A lookup reads one or two
+    slots of the mapping.
+
+    Inputs:
+        fname (str): the .npy file of the table
+    '''
+    _tables = {}
+    dtype = np.dtype([('hash', np.uint64), ('value', np.int8)])
+
+    def __init__(self, fname):
+        self.fname = fname
+        data = np.load(fname, mmap_mode='r')
+        self.hashes, self.values = np.asarray(data['hash']), np.asarray(data['value'])
+        self.mask = len(self.hashes)-1
+
+    def __len__(self):
+        return int((self.hashes!=0).sum())
+
+    def __reduce__(self):
+        return (endgame_table.load, (self.fname,))
+
+    @staticmethod
+    def load(fname=f'{data_pth}/endgame.npy'):
+        '''Open the mapping of fname, once per process'''
+        fname = os.path.abspath(fname)
+        if fname not in endgame_table._tables:
+            endgame_table._tables[fname] = endgame_table(fname)
+        return endgame_table._tables[fname]
+
+    def lookup(self, h):
+        '''The value of a canonical hash, None if not in the table'''
+        slot = h & self.mask
+        while True:
+            slot_hash = int(self.hashes[slot])
+            if slot_hash==0: return None
+            if slot_hash==h: return int(self.values[slot])
+            slot = (slot+1) & self.mask
+
+    @staticmethod
+    def build(states, fname=f'{data_pth}/endgame.npy', max_empty=6):
+        '''Solve the endgames of a set of positions
+
+        Every position that is not over and has at most 
+        max_empty empty cells is solved, along with all the
+        positions below it, e.g. the positions of the 
+        dataset (see position_index) or of self-play logs.
+
+        Inputs:
+            states (iterable): (board, curr_player) tuples
+            fname (str): the .npy file to write
+            max_empty (int): the most empty cells of a position
+        '''
+        solved = {}
+        for state in states:
+            board = four_in_a_row.encode(state[0])
+            if (board==four_in_a_row.not_occupied).sum()>max_empty: continue
+            position = search_position((board, int(state[1])))
+            if not position.done: position.solve(solved)
+
+        n_slots = 1 << int(np.ceil(np.log2(max(2*len(solved), 2))))
+        data = np.zeros(n_slots, dtype=endgame_table.dtype)
+        for h, value in solved.items():
+            slot = h & (n_slots-1)
+            while data['hash'][slot]!=0: slot = (slot+1) & (n_slots-1)
+            data[slot] = (h, value)
+        # write then rename, so readers never see a partial file
+        tmp_fname = f'{fname}.{os.getpid()}.tmp'
+        with open(tmp_fname, 'wb') as f: np.save(f, data)
+        os.replace(tmp_fname, fname)
+        endgame_table._tables.pop(os.path.abspath(fname), None)
+
+# ---------------- Feature database ---------------- #
+
+class feature_db:
+    '''On-disk tier of the feature cache (see feature_fn.feature_cache)
+
+    The raw features of the positions, keyed by the Zobrist 
+    hash of the board, in a sqlite database in WAL mode, so
+    that many processes read it while one of them writes. 
+    Each process opens its own connection; the new rows are
+    written in batches of flush_size, or on flush().
+
+    Inputs:
+        fname (str): the sqlite file
+        flush_size (int): the most rows kept before a write
+    '''
+    shape = (2, 5)
+
+    def __init__(self, fname=f'{data_pth}/cache/features.db', flush_size=4096):
+        self.fname = fname
+        self.flush_size = flush_size
+        self.pending = {}
+        self.conn, self.pid = None, None
+
+    def __getstate__(self):
+        self.flush()
+        return {'fname': self.fname, 'flush_size': self.flush_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        self.flush()
+        return self.connect().execute('SELECT COUNT(*) FROM features').fetchone()[0]
+
+    def connect(self):
+        '''The connection of this process'''
+        if self.conn is None or self.pid!=os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.fname)), exist_ok=True)
+            self.conn, self.pid = sqlite3.connect(self.fname, timeout=60), os.getpid()
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS features '
+                              '(key INTEGER PRIMARY KEY, value BLOB NOT NULL)')
+            self.conn.commit()
+        return self.conn
+
+    @staticmethod
+    def to_sql(keys):
+        '''The keys as sqlite integers (signed 64 bits)'''
+        return np.array(keys, dtype=np.uint64).view(np.int64).tolist()
+
+    def get_many(self, keys, chunk_size=512):
+        '''The features of the keys in the database
+
+        Outputs:
+            features (dict): key to (2, 5) features, only 
+                the keys found
+        '''
+        found = {k: self.pending[k] for k in keys if k in self.pending}
+        sql_keys = self.to_sql([k for k in keys if k not in found])
+        conn = self.connect()
+        for i in range(0, len(sql_keys), chunk_size):
+            chunk = sql_keys[i:i+chunk_size]
+            rows = conn.execute(f'SELECT key, value FROM features WHERE key IN ({",".join("?"*len(chunk))})', 
+                                chunk).fetchall()
+            for key, value in rows:
+                found[key & 0xFFFFFFFFFFFFFFFF] = np.frombuffer(value, dtype=np.float64).reshape(self.shape)
+        return found
+
+    def put_many(self, keys, features):
+        '''Add the features of the keys'''
+        for key, value in zip(keys, features): self.pending[key] = value
+        if len(self.pending)>=self.flush_size: self.flush()
+
+    def flush(self):
+        '''Write the new rows in one transaction'''
+        if not self.pending: return
+        keys, values = list(self.pending.keys()), list(self.pending.values())
+        with self.connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO features VALUES (?, ?)', 
+                             zip(self.to_sql(keys), 
+                                 [np.ascontiguousarray(v, dtype=np.float64).tobytes() for v in values]))
+        self.pending = {}
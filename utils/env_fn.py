@@ -2,12 +2,120 @@ import os
 import pygame
 import pickle
 import numpy as np 
+import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from copy import deepcopy
 
 pth = os.path.dirname(os.path.abspath(__file__))
 
+# ---------------- Line index ---------------- #
+
+directions = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+def get_lines(rows, cols, win_length):
+    '''Enumerate the winning lines of the board
+
+    A line is win_length consecutive cells in one of
+    the four directions: horizontal, vertical, diagonal1
+    (top-left to bottom-right), diagonal2 (top-right to 
+    bottom-left). Cells are flat indices r*cols+c.
+
+    Inputs:
+        rows, cols (int): the size of the board
+        win_length (int): the number of cells in a line
+
+    Outputs:
+        lines (np.ndarray): (n_lines, win_length), the cells of each line
+        cell_lines (list): for each cell, the indices of the lines 
+            passing through it
+        cell_line_cells (list): for each cell, the cells of the lines
+            passing through it, (n_cell_lines, win_length)
+    '''
+    lines = []
+    for dr, dc in directions:
+        for r in range(rows):
+            for c in range(cols):
+                cells = [(r+k*dr, c+k*dc) for k in range(win_length)]
+                if all(0<=i<rows and 0<=j<cols for i, j in cells):
+                    lines.append([i*cols+j for i, j in cells])
+    lines = np.array(lines)
+    cell_lines = [np.where((lines==i).any(axis=1))[0] for i in range(rows*cols)]
+    cell_line_cells = [lines[l] for l in cell_lines]
+    return lines, cell_lines, cell_line_cells
+
+def get_neighbors(rows, cols, offsets=(-2, -1, 1, 2, 3)):
+    '''The neighbors of each cell along the four directions
+
+    Used by the heuristic pattern counters, which look at 
+    the cells at offsets -2, -1, +1, +2, +3 from a piece.
+
+    Outputs:
+        neighbors (list): neighbors[i][d] is a tuple of the flat 
+            indices of the cells at the offsets from cell i along 
+            direction d, -1 if the cell is off the board
+    '''
+    neighbors = []
+    for r in range(rows):
+        for c in range(cols):
+            cell = []
+            for dr, dc in directions:
+                idx = []
+                for k in offsets:
+                    i, j = r+k*dr, c+k*dc
+                    idx.append(i*cols+j if 0<=i<rows and 0<=j<cols else -1)
+                cell.append(tuple(idx))
+            neighbors.append(cell)
+    return neighbors
+
+# ---------------- Zobrist hashing ---------------- #
+
+def get_zobrist(rows, cols, seed=2023):
+    '''Random 64-bit keys of the Zobrist hash
+
+    The hash of a position is the XOR of the key of 
+    every (player, cell) piece on the board, XOR-ed with
+    the side key when white is to move. Dropping or 
+    removing a piece is a single XOR with its key.
+
+    Outputs:
+        keys (list): keys[player_id][cell], python ints
+        side (int): the key of white to move
+    '''
+    rng = np.random.default_rng(seed)
+    keys = rng.integers(0, 2**64, size=[2, rows*cols], dtype=np.uint64)
+    side = rng.integers(0, 2**64, dtype=np.uint64)
+    return keys.tolist(), int(side)
+
+# ---------------- Symmetries ---------------- #
+
+def get_symmetries(rows, cols, zobrist):
+    '''Cell permutations of the board symmetries
+
+    The transforms are coded by two bits: bit 0 flips 
+    left-right, bit 1 flips top-bottom, so 0 is the 
+    identity and 3 the 180 degree rotation. Each 
+    transform is its own inverse.
+
+    Inputs:
+        rows, cols (int): the size of the board
+        zobrist (list): the Zobrist keys, see get_zobrist
+
+    Outputs:
+        perms (np.ndarray): (4, rows*cols), perms[t][i] is the
+            cell that cell i is mapped to by transform t
+        keys (list): keys[t][player_id][i], the Zobrist key of
+            a piece on cell i seen through transform t
+    '''
+    r, c = np.divmod(np.arange(rows*cols), cols)
+    perms = []
+    for t in range(4):
+        r_t = rows-1-r if t & 2 else r
+        c_t = cols-1-c if t & 1 else c
+        perms.append(r_t*cols+c_t)
+    keys = [[[player_keys[i] for i in perm] for player_keys in zobrist] for perm in perms]
+    return np.array(perms), keys
+
 class four_in_a_row:
     name = 'four_in_a_row'
     rows = 4
@@ -17,13 +125,29 @@ class four_in_a_row:
     lose_reward = -1
     draw_reward = 0
     center = np.array([1.5, 4])
+    # the (row, col) of each flat cell, and the center value of 
+    # a piece on it, 1/distance to the center
+    cell_coords = np.indices([rows, cols]).reshape([2, -1]).T
+    center_values = 1/np.linalg.norm(cell_coords-center, axis=1)
     player1_color = 0 # black
     player2_color = 1 # white
-    not_occupied = .75 # the available grid 
+    not_occupied = -1 # the available grid 
+    float_not_occupied = .75 # the available grid in the float boards
+    board_dtype = np.int8 # boards are int8: -1 empty, 0 black, 1 white
     cell_size = 100
+    # precomputed line index, built once at import
+    lines, cell_lines, cell_line_cells = get_lines(rows, cols, win_length)
+    neighbors = get_neighbors(rows, cols)
+    # Zobrist keys, the hash of the empty board with black to move is 0
+    zobrist, zobrist_side = get_zobrist(rows, cols)
+    # left-right and top-bottom reflections, and the Zobrist 
+    # keys of a piece seen through each of them 
+    n_symmetries = 4
+    symmetry_perms, symmetry_zobrist = get_symmetries(rows, cols, zobrist)
 
     @staticmethod
     def get_valid_actions(board):
+        board = four_in_a_row.encode(board)
         if four_in_a_row.check_draw(board, four_in_a_row.not_occupied):
             return []
         elif four_in_a_row.check_win(board, four_in_a_row.not_occupied):
@@ -33,7 +157,7 @@ class four_in_a_row:
             return [(i[0], i[1]) for i in l]
     
     @staticmethod
-    def check_win(board, not_occupied=.75):
+    def check_win(board, not_occupied=-1):
         """Wining condition check
         
         Check if there are 
@@ -62,48 +186,19 @@ class four_in_a_row:
                 x
                     x
 
-        The lru_cache is used to cache the result of the function. This 
-        can be used to speed up the function.
+        All the lines are looked up in the precomputed 
+        line index four_in_a_row.lines.
 
         Inputs:
             board (np.ndarray): the board of the game
-            not_occupied (float): the value of the not occupied grid
+            not_occupied (int): the value of the not occupied grid
         Outputs:
             done (bool): whether the game is win or not finished
         """
-        rows, cols = board.shape
-        not_occupied = four_in_a_row.not_occupied
-        # check horizontal
-        # check horizontal
-        for i in range(rows):
-            for j in range(cols-3):
-                # for each unoccupied grid
-                q1 = board[i, j]!=not_occupied
-                q2 = board[i, j]==board[i, j+1]==board[i, j+2]==board[i, j+3]
-                if q1 and q2: return True
-                    
-        # check vertical
-        for i in range(rows-3):
-            for j in range(cols):
-                q1 = board[i, j]!=not_occupied
-                q2 = board[i, j]==board[i+1, j]==board[i+2, j]==board[i+3, j]
-                if q1 and q2: return True
-
-        # check diagonal1 (top-left to bottom-right)
-        for i in range(rows-3):
-            for j in range(cols-3):
-                q1 = board[i, j]!=not_occupied
-                q2 = board[i, j]==board[i+1, j+1]==board[i+2, j+2]==board[i+3, j+3]
-                if q1 and q2: return True
-
-        # check diagonal2 (top-right to bottom-left)
-        for i in range(rows-3):
-            for j in range(3, cols):
-                q1 = board[i, j]!=not_occupied
-                q2 = board[i, j]==board[i+1, j-1]==board[i+2, j-2]==board[i+3, j-3]
-                if q1 and q2: return True
-
-        return False
+        board = four_in_a_row.encode(board)
+        cells = board.ravel()[four_in_a_row.lines]
+        occupied = cells[:, 0]!=four_in_a_row.not_occupied
+        return bool((occupied & (cells==cells[:, :1]).all(axis=1)).any())
 
     @staticmethod
     def check_win_action(board, action, player_id=0):
@@ -135,63 +230,22 @@ class four_in_a_row:
                 x
             x        
         
+        Only the lines through the action, looked up in
+        four_in_a_row.cell_line_cells, are checked.
+        
         Inputs:
             board (np.ndarray): the board of the game
             action (tuple): the action to take
-            not_occupied (float): the value of the not occupied grid
+            player_id (int): the player who took the action
         '''
-        rows, cols = board.shape
-        x, y = action
-        
-        # Check horizontal
-        count = 0
-        for c in range(max(0, y-3), min(cols, y+4)):
-            if board[x, c]==player_id:
-                count += 1
-                if count >= 4:
-                    return True
-            else:
-                count = 0
-
-        # Check vertical
-        count = 0
-        for r in range(max(0, x-3), min(rows, x+4)):
-            if board[r, y]==player_id:
-                count += 1
-                if count >= 4:
-                    return True
-            else:
-                count = 0
-
-        # Check diagonal1 (top-left to bottom-right)
-        count = 0
-        for i in range(-3, 4):
-            r, c = x+i, y+i
-            if 0<=r<rows and 0<=c<cols:
-                if board[r, c]==player_id:
-                    count += 1
-                    if count >= 4:
-                        return True
-                else:
-                    count = 0
-
-        # Check diagonal2 (top-right to bottom-left)
-        count = 0
-        for i in range(-3, 4):
-            r, c = x+i, y-i
-            if 0<=r<rows and 0<=c<cols:
-                if board[r, c]==player_id:
-                    count += 1
-                    if count >= 4:
-                        return True
-                else:
-                    count = 0
-
-        return False
+        idx = four_in_a_row.action2idx(action)
+        board = four_in_a_row.encode(board)
+        cells = board.ravel()[four_in_a_row.cell_line_cells[idx]]
+        return bool((cells==player_id).all(axis=1).any())
 
     @staticmethod
-    def check_draw(board, not_occupied=.75):
-        return np.all(board!=not_occupied)
+    def check_draw(board, not_occupied=-1):
+        return not (four_in_a_row.encode(board)==not_occupied).any()
     
     @staticmethod
     def determine(board):
@@ -267,6 +321,7 @@ class four_in_a_row:
         '''
         # the board and the current player
         board, curr_player = state
+        board = self.encode(board)
         x, y = action
         reward, done, info = 0, False, {}
 
@@ -281,21 +336,16 @@ class four_in_a_row:
             # switch the player
             curr_player_next = 1-curr_player
 
-            # check if the game is draw
-            draw = self.check_draw(board, four_in_a_row.not_occupied)
-
-            # check if the game is finished
-            if not draw:
-                done = self.check_win_action(board, action, curr_player)
-                if done:
-                    #print('winner', last_player)
-                    reward = four_in_a_row.win_reward 
-                    winner = 'black' if curr_player==0 else 'white'
-                    info = {'winner': winner}
-                else:
-                    reward = 0
-                    info = {}
-            else:
+            # check if the game is finished, on the board
+            # after the piece is dropped. A winning last 
+            # move that fills the board counts as a win.
+            win = self.check_win_action(board_next, action, curr_player)
+            if win:
+                done = True
+                reward = four_in_a_row.win_reward 
+                winner = 'black' if curr_player==0 else 'white'
+                info = {'winner': winner}
+            elif self.check_draw(board_next, four_in_a_row.not_occupied):
                 done = True
                 info = {'winner': 'draw'}
 
@@ -303,17 +353,234 @@ class four_in_a_row:
             return next_state, reward, done, info
 
         return state, reward, done, info
+
+    @staticmethod
+    def transit_batch(boards, players, actions):
+        '''Batched transition over a stack of independent games
+
+        Apply the rules of transit to N games in one NumPy pass.
+        The win check sums the mover's pieces over the lines of 
+        the precomputed line index; a line through the new piece
+        summing to win_length is a win. Invalid actions (occupied cells) leave the game
+        unchanged, as in transit.
+
+        Inputs:
+            boards (np.ndarray): (N, rows, cols), the boards of the games
+            players (np.ndarray): (N,), the player to move in each game
+            actions (np.ndarray): (N,), the action index (see action2idx)
+                of each game, or (N, 2) the (row, col) of each action
+
+        Outputs:
+            tuple: (next_states, rewards, dones, winners)
+                * next_states: (boards_next, players_next), (N, rows, cols) and (N,)
+                * rewards: (N,), 1 for the winning move, 0 otherwise
+                * dones: (N,), whether each game is over
+                * winners: (N,), the id of the winner, -1 for draw or unfinished 
+        '''
+        boards = four_in_a_row.encode(boards)
+        n = boards.shape[0]
+        players = np.asarray(players)
+        actions = np.asarray(actions)
+        if actions.ndim==2: 
+            actions = actions[:, 0]*four_in_a_row.cols+actions[:, 1]
+        rows_idx = np.arange(n)
+
+        # drop the pieces on the valid cells
+        boards_next = boards.copy()
+        flat = boards_next.reshape([n, -1])
+        valid = flat[rows_idx, actions]==four_in_a_row.not_occupied
+        flat[rows_idx[valid], actions[valid]] = players[valid]
+        players_next = np.where(valid, 1-players, players)
+
+        # window sums of the mover's pieces over the lines,
+        # only the lines through the new piece can be a win
+        lines = four_in_a_row.lines
+        owned = flat==players[:, None]
+        line_sums = owned[:, lines].sum(axis=2)
+        through = (lines==actions[:, None, None]).any(axis=2)
+        win = valid & ((line_sums==four_in_a_row.win_length) & through).any(axis=1)
+        full = (flat!=four_in_a_row.not_occupied).all(axis=1)
+        draw = valid & ~win & full
+
+        rewards = np.where(win, four_in_a_row.win_reward, 0)
+        dones = win | draw
+        winners = np.where(win, players, -1)
+        return (boards_next, players_next), rewards, dones, winners
+
+    def perft(self, state, depth):
+        '''Count the game tree below a state, by transit
+
+        Every valid action is played, down to depth plies or
+        the end of the game. The counts of the engines must 
+        match exactly, which makes it a test of the move
+        generation and of the end-of-game checks, and the 
+        nodes per second a benchmark of them.
+
+        Inputs:
+            state (tuple): (board, curr_player), not terminal
+            depth (int): the number of plies
+
+        Outputs:
+            nodes (int): the number of transitions
+            wins (int): the transitions that win the game
+            draws (int): the transitions that draw the game
+        '''
+        nodes, wins, draws = 0, 0, 0
+        if depth==0: return nodes, wins, draws
+        for action in self.get_valid_actions(state[0]):
+            next_state, reward, done, _ = self.transit(state, action)
+            nodes += 1
+            if done:
+                wins += reward==four_in_a_row.win_reward
+                draws += reward!=four_in_a_row.win_reward
+                continue
+            sub_nodes, sub_wins, sub_draws = self.perft(next_state, depth-1)
+            nodes, wins, draws = nodes+sub_nodes, wins+sub_wins, draws+sub_draws
+        return nodes, wins, draws
+
+    @staticmethod
+    def perft_batch(state, depth):
+        '''Count the game tree below a state, by transit_batch
+
+        The tree is expanded one ply at a time, all the 
+        positions of a ply in one batch. See perft.
+        '''
+        boards = four_in_a_row.encode(state[0])[None]
+        players = np.array([state[1]])
+        nodes, wins, draws = 0, 0, 0
+        for _ in range(depth):
+            if len(boards)==0: break
+            flat = boards.reshape([boards.shape[0], -1])
+            games, actions = np.nonzero(flat==four_in_a_row.not_occupied)
+            (boards, players), _, dones, winners = \
+                four_in_a_row.transit_batch(boards[games], players[games], actions)
+            nodes += len(actions)
+            wins += int((winners!=-1).sum())
+            draws += int((dones & (winners==-1)).sum())
+            boards, players = boards[~dones], players[~dones]
+        return nodes, wins, draws
+
+    @staticmethod
+    def zobrist_hash(state):
+        '''The 64-bit Zobrist hash of a state, O(cells)
+
+        Use it once for a new state, and zobrist_update 
+        to follow the hash along the moves.
+
+        Inputs:
+            state (tuple): (board, curr_player)
+
+        Outputs:
+            hash (int): the hash of the state
+        '''
+        board, curr_player = state
+        flat = four_in_a_row.encode(board).ravel()
+        h = 0
+        for player_id in [four_in_a_row.player1_color, four_in_a_row.player2_color]:
+            for idx in np.flatnonzero(flat==player_id):
+                h ^= four_in_a_row.zobrist[player_id][idx]
+        if curr_player==four_in_a_row.player2_color: h ^= four_in_a_row.zobrist_side
+        return h
+
+    @staticmethod
+    def zobrist_update(h, action, player_id):
+        '''The hash after (or before) player_id plays action, O(1)
+
+        The update is its own inverse: applying it again
+        takes the action back.
+        '''
+        idx = four_in_a_row.action2idx(action)
+        return h ^ four_in_a_row.zobrist[player_id][idx] ^ four_in_a_row.zobrist_side
+
+    # ---------------- symmetries ---------------- #
+
+    @staticmethod
+    def transform_board(board, transform):
+        '''Apply a symmetry transform (0-3) to the board, a view'''
+        if transform & 1: board = board[..., :, ::-1]
+        if transform & 2: board = board[..., ::-1, :]
+        return board
+
+    @staticmethod
+    def transform_action(action, transform):
+        '''Map an action through a symmetry transform 
+
+        The transforms are their own inverse, so the same 
+        function maps an action of the canonical board back
+        to the original board.
+        '''
+        x, y = action
+        if transform & 1: y = four_in_a_row.cols-1-y
+        if transform & 2: x = four_in_a_row.rows-1-x
+        return (x, y)
+
+    @staticmethod
+    def canonicalize(board):
+        '''Map the board to its canonical orientation
+
+        The pieces can be dropped on any empty grid and the 
+        center is symmetric, so a position and its left-right 
+        and top-bottom reflections are strategically equivalent. 
+        The canonical orientation is the one with the smallest 
+        bytes among the four.
+
+        Inputs:
+            board (np.ndarray): the board of the game
+
+        Outputs:
+            canonical_board (np.ndarray): the board in canonical orientation
+            transform (int): the transform from the board to the canonical
+                board, use transform_action to map actions either way
+        '''
+        board = four_in_a_row.encode(board)
+        views = [four_in_a_row.transform_board(board, t) for t in range(four_in_a_row.n_symmetries)]
+        transform = min(range(four_in_a_row.n_symmetries), key=lambda t: views[t].tobytes())
+        return np.ascontiguousarray(views[transform]), transform
+
+    @staticmethod
+    def symmetry_hashes(state):
+        '''The Zobrist hashes of the state under each transform'''
+        board, curr_player = state
+        flat = four_in_a_row.encode(board).ravel()
+        hashes = [0]*four_in_a_row.n_symmetries
+        for player_id in [four_in_a_row.player1_color, four_in_a_row.player2_color]:
+            for idx in np.flatnonzero(flat==player_id):
+                for t, keys in enumerate(four_in_a_row.symmetry_zobrist):
+                    hashes[t] ^= keys[player_id][idx]
+        if curr_player==four_in_a_row.player2_color:
+            hashes = [h ^ four_in_a_row.zobrist_side for h in hashes]
+        return hashes
+
+    @staticmethod
+    def canonical_hash(state):
+        '''The hash of the equivalence class of the state
+
+        The smallest Zobrist hash among the four orientations,
+        the same for a position and its reflections. Use it 
+        as the key of caches and tables that should store one
+        entry per equivalence class.
+        '''
+        return min(four_in_a_row.symmetry_hashes(state))
+
+    @staticmethod
+    def position(state):
+        '''A mutable search position of the state, see search_position'''
+        return search_position(state)
      
     def reset(self):
         """Reset the environment to initial state"""
-        self.board = np.ones([self.rows, self.cols])*self.not_occupied
+        self.board = np.full([self.rows, self.cols], self.not_occupied, dtype=self.board_dtype)
         self.curr_player = self.player1_color
         self.state = (self.board.copy(), self.curr_player)
+        self.hash = 0
         return self.state 
     
     def step(self, action):
         """Take a step in the environment"""
         next_state, reward, done, info = self.transit(self.state, action)
+        # an invalid action returns the same state
+        if next_state is not self.state:
+            self.hash = self.zobrist_update(self.hash, action, self.curr_player)
         self.state = next_state
         self.board = next_state[0]
         self.curr_player = next_state[1]
@@ -328,7 +595,7 @@ class four_in_a_row:
                 * 'game': pygame mode 
         """
         if mode=='plt':
-            empty_board = np.ones([self.rows, self.cols])*self.not_occupied
+            empty_board = np.ones([self.rows, self.cols])*self.float_not_occupied
             # Draw filled scatter points on non-empty grids
             sns.heatmap(empty_board, cmap='gray', vmin=0, vmax=1, 
                         lw=.1, square=True, cbar=False)
@@ -420,13 +687,76 @@ class four_in_a_row:
                 * board: np.ndarray, the board of the game
                 * curr_player: int, 1-black player, 2-white player
         '''
-        # load idx2state
-        fname = f'{pth}/../data/human_vs_human-idx2state.pkl'
-        with open(fname, 'rb') as f: idx2state = pickle.load(f)
-        design = idx2state[state_idx]
-        board = design[:-1].reshape([four_in_a_row.rows, four_in_a_row.cols])
-        player_id = int(design[-1])
-        return (board, player_id)
+        # the memory-mapped store of the dataset, opened once 
+        # per process, see data_fn.use_dataset
+        from .data_fn import dataset_store
+        return dataset_store().embed(state_idx)
+
+    @staticmethod
+    def get_threats(board):
+        '''The cells that complete four for each player
+
+        The cells where black, or white, wins by playing 
+        next, found by shift-and-mask operations on the 
+        bitboard (see bitboard_four_in_a_row.threats) instead
+        of check_win_action on every empty cell.
+
+        Inputs:
+            board (np.ndarray): the board of the game
+
+        Outputs:
+            threats (tuple): (black, white), the lists of the 
+                (row, col) cells of each player, row-major
+        '''
+        black, white = bitboard_four_in_a_row.board2bits(four_in_a_row.encode(board))
+        empty = bitboard_four_in_a_row.full_mask ^ (black | white)
+        return tuple(bitboard_four_in_a_row.bits2actions(bitboard_four_in_a_row.threats(mask, empty))
+                     for mask in [black, white])
+
+    @staticmethod
+    def endgame_value(state):
+        '''The exact value of a near-full position, O(1)
+
+        Looks the position up in the endgame table (see 
+        data_fn.endgame_table), opened once per process.
+
+        Inputs:
+            state (tuple): (board, curr_player)
+
+        Outputs:
+            value (int): 1 win, 0 draw, -1 loss for the 
+                player to move, None if not in the table
+        '''
+        from .data_fn import endgame_table
+        return endgame_table.load().lookup(four_in_a_row.canonical_hash(state))
+
+    @staticmethod
+    def embed_many(idx_array):
+        '''Embed a batch of state indices
+
+        Inputs:
+            idx_array (np.ndarray): the indices of the states
+
+        Outputs:
+            boards (np.ndarray): (N, rows, cols) the int8 boards
+            players (np.ndarray): (N,) the player to move
+        '''
+        from .data_fn import dataset_store
+        return dataset_store().embed_many(idx_array)
+
+    @staticmethod
+    def embed_features(idx_array):
+        '''The raw heuristic features of a batch of state indices,
+        read from the feature table of the state store
+
+        Inputs:
+            idx_array (np.ndarray): the indices of the states
+
+        Outputs:
+            features (np.ndarray): (N, 2, 5) see feature_fn.get_features
+        '''
+        from .data_fn import dataset_features
+        return dataset_features()[idx_array]
 
     @staticmethod
     def get_design_response_mat(sub_data):
@@ -439,27 +769,70 @@ class four_in_a_row:
             design matrix (NxK) for the block data.
             N is the number of trials within the block.
 
+        The blocks are concatenated and the columns are
+        converted in bulk: the action strings, e.g. '(1, 4)',
+        are parsed by one regular expression instead of 
+        eval-ing each trial.
+
         Inputs:
             sub_data (dict): the subject data
                 * key: block_id, value: block_data
+                A single DataFrame, or the file name of the
+                subject data (see data_fn.load_design_response, 
+                cached on disk), are also accepted.
 
         Outputs:
             design_matrix (np.ndarray): the design matrix
             response_matrix (np.ndarray): the response matrix
         '''
-        design_matrix = []
-        response_matrix = []
-        block_lst = sub_data.keys()
-        for block in block_lst:
-            block_data = sub_data[block]
-            for _, row in block_data.iterrows():
-                state_idx = row['state_idx']
-                # save the state idx 
-                design_matrix.append(state_idx)
-                # save the action idx 
-                action_idx = four_in_a_row.action2idx(eval(row['action']))
-                response_matrix.append(action_idx)
-        return np.array(design_matrix), np.array(response_matrix)
+        if isinstance(sub_data, str):
+            from .data_fn import load_design_response
+            return load_design_response(sub_data)
+        if isinstance(sub_data, dict):
+            blocks = [sub_data[block] for block in sub_data.keys()]
+            if len(blocks)==0: return np.array([]), np.array([])
+            sub_data = pd.concat(blocks, ignore_index=True)
+        design_matrix = sub_data['state_idx'].to_numpy()
+        response_matrix = four_in_a_row.parse_actions(sub_data['action'])
+        return design_matrix, response_matrix
+
+    @staticmethod
+    def parse_actions(actions):
+        '''Convert a column of action strings to action indices
+
+        Inputs:
+            actions (pd.Series): e.g. '(1, 4)', '[1,4]' or 
+                '(np.int64(1), np.int64(4))'
+
+        Outputs:
+            action_idx (np.ndarray): the action indices
+        '''
+        actions = pd.Series(actions).astype(str)
+        actions = actions.str.replace(r'np\.u?int\d+\(', '', regex=True)
+        coords = actions.str.extract(r'(\d+)\D+(\d+)').astype(int).to_numpy()
+        return coords[:, 0]*four_in_a_row.cols+coords[:, 1]
+
+    @staticmethod
+    def encode(board):
+        '''Convert a board to the int8 format used internally
+
+        Float boards (.75 for the available grid, as produced 
+        by layout2board) are converted, int8 boards are 
+        returned as they are. Works on stacks of boards.
+        '''
+        board = np.asarray(board)
+        if board.dtype==four_in_a_row.board_dtype: return board
+        board = np.where(board==four_in_a_row.float_not_occupied, 
+                         four_in_a_row.not_occupied, board)
+        return board.astype(four_in_a_row.board_dtype)
+    
+    @staticmethod
+    def decode(board):
+        '''Convert an int8 board back to the float format'''
+        board = np.asarray(board)
+        if board.dtype!=four_in_a_row.board_dtype: return board
+        return np.where(board==four_in_a_row.not_occupied, 
+                        four_in_a_row.float_not_occupied, board).astype(float)
 
     @staticmethod
     def layout2board(layout):
@@ -467,6 +840,7 @@ class four_in_a_row:
 
     @staticmethod
     def board2layout(board):
+        board = four_in_a_row.decode(board)
         return [''.join(['.' if x==0.75 else '0' if x==0 else '1' for x in row]) for row in board]
 
     @staticmethod
@@ -480,6 +854,426 @@ class four_in_a_row:
         '''Convert the integer to coordinates'''
         return idx//four_in_a_row.cols, idx%four_in_a_row.cols
 
+# ---------------- Bitboard engine ---------------- #
+
+def get_bit_lines(rows, cols, win_length):
+    '''Precompute the shift-and-mask tables of a bitboard
+
+    The cell (r, c) is the bit r*cols+c. For each direction
+    a line of win_length pieces starting at bit s occupies
+    bits s, s+shift, ..., s+(win_length-1)*shift, so AND-ing 
+    the mask with its shifted copies leaves only the start 
+    bits of complete lines. 
+
+    Inputs:
+        rows, cols (int): the size of the board
+        win_length (int): the number of pieces in a line
+
+    Outputs:
+        shifts (list): the bit shift of each direction
+        starts (list): the valid start bits of each direction
+        through (list): for each cell, the (shift, start mask)
+            pairs of the lines that pass through the cell
+    '''
+    directions = [(0, 1), (1, 0), (1, 1), (1, -1)]
+    shifts, starts = [], []
+    through = [[0]*len(directions) for _ in range(rows*cols)]
+    for d, (dr, dc) in enumerate(directions):
+        shift, start = dr*cols+dc, 0
+        for r in range(rows):
+            for c in range(cols):
+                r_end, c_end = r+(win_length-1)*dr, c+(win_length-1)*dc
+                if not (0<=r_end<rows and 0<=c_end<cols): continue
+                start |= 1 << (r*cols+c)
+                for k in range(win_length):
+                    through[(r+k*dr)*cols+c+k*dc][d] |= 1 << (r*cols+c)
+        shifts.append(shift)
+        starts.append(start)
+    through = [[(shifts[d], m) for d, m in enumerate(cell) if m] for cell in through]
+    return shifts, starts, through
+
+class bitboard_four_in_a_row(four_in_a_row):
+    '''Bitboard engine of the four in a row game
+
+    Each position is stored as two 36-bit integer masks, 
+    one per player, where bit r*cols+c is set if the player
+    has a piece at (r, c). Win detection, legal move generation
+    and draw detection are shift-and-mask operations on the 
+    masks instead of loops over the cells. 
+
+    The states are (board, curr_player) tuples, as in
+    four_in_a_row, so the agents can use either engine. The
+    engine keeps the masks of its own state along it (see 
+    reset and step), and the search of perft walks on the
+    masks only (see transit_bits); transit and the static 
+    functions on boards convert the board on each call.
+    '''
+    name = 'bitboard_four_in_a_row'
+    n_cells = four_in_a_row.rows*four_in_a_row.cols
+    full_mask = (1 << n_cells) - 1
+    bit_weights = 1 << np.arange(n_cells, dtype=np.uint64)
+    bit_actions = [(i//four_in_a_row.cols, i%four_in_a_row.cols) for i in range(n_cells)]
+    shifts, starts, through = get_bit_lines(four_in_a_row.rows, 
+                                            four_in_a_row.cols, 
+                                            four_in_a_row.win_length)
+
+    @staticmethod
+    def board2bits(board):
+        '''Convert the board to the (black, white) masks'''
+        flat = board.ravel()
+        weights = bitboard_four_in_a_row.bit_weights
+        black = int(weights[flat==four_in_a_row.player1_color].sum())
+        white = int(weights[flat==four_in_a_row.player2_color].sum())
+        return black, white
+
+    @staticmethod
+    def bits2board(black, white):
+        '''Convert the (black, white) masks to the board'''
+        n_cells = bitboard_four_in_a_row.n_cells
+        board = np.full([n_cells], four_in_a_row.not_occupied, dtype=four_in_a_row.board_dtype)
+        for i in range(n_cells):
+            if (black >> i) & 1: board[i] = four_in_a_row.player1_color
+            elif (white >> i) & 1: board[i] = four_in_a_row.player2_color
+        return board.reshape([four_in_a_row.rows, four_in_a_row.cols])
+
+    @staticmethod
+    def has_four(mask):
+        '''Whether the mask contains a complete line'''
+        for shift, start in zip(bitboard_four_in_a_row.shifts, 
+                                bitboard_four_in_a_row.starts):
+            x = mask & start & (mask >> shift)
+            x &= mask >> 2*shift
+            x &= mask >> 3*shift
+            if x: return True
+        return False
+
+    @staticmethod
+    def has_four_through(mask, idx):
+        '''Whether the mask contains a complete line through bit idx'''
+        for shift, start in bitboard_four_in_a_row.through[idx]:
+            x = mask & start & (mask >> shift)
+            x &= mask >> 2*shift
+            x &= mask >> 3*shift
+            if x: return True
+        return False
+
+    @staticmethod
+    def threats(mask, empty):
+        '''The empty cells that complete a line of the mask
+
+        A line starting at bit s is a threat at its k-th cell
+        when its other three cells are in the mask: AND-ing 
+        the shifted copies of the mask, leaving out the k-th 
+        one, gives the starts of those lines, and shifting 
+        them back by k cells gives the threat cells. 
+
+        Inputs:
+            mask (int): the pieces of one player
+            empty (int): the empty cells
+
+        Outputs:
+            threats (int): the mask of the winning cells
+        '''
+        threats = 0
+        for shift, start in zip(bitboard_four_in_a_row.shifts, 
+                                bitboard_four_in_a_row.starts):
+            m1, m2, m3 = mask >> shift, mask >> 2*shift, mask >> 3*shift
+            threats |= start & m1 & m2 & m3
+            threats |= (start & mask & m2 & m3) << shift
+            threats |= (start & mask & m1 & m3) << 2*shift
+            threats |= (start & mask & m1 & m2) << 3*shift
+        return threats & empty
+
+    @staticmethod
+    def bits2actions(mask):
+        '''The cells of a mask, in row-major order'''
+        bit_actions = bitboard_four_in_a_row.bit_actions
+        return [bit_actions[i] for i in range(bitboard_four_in_a_row.n_cells) 
+                if (mask >> i) & 1]
+
+    @staticmethod
+    def legal_actions(black, white):
+        '''The empty cells of a position, in row-major order'''
+        occupied = black | white
+        bit_actions = bitboard_four_in_a_row.bit_actions
+        return [bit_actions[i] for i in range(bitboard_four_in_a_row.n_cells) 
+                if not (occupied >> i) & 1]
+
+    @staticmethod
+    def get_valid_actions(board):
+        black, white = bitboard_four_in_a_row.board2bits(board)
+        if (black | white)==bitboard_four_in_a_row.full_mask:
+            return []
+        elif bitboard_four_in_a_row.has_four(black) or bitboard_four_in_a_row.has_four(white):
+            return []
+        else:
+            return bitboard_four_in_a_row.legal_actions(black, white)
+
+    @staticmethod
+    def check_win(board, not_occupied=-1):
+        black, white = bitboard_four_in_a_row.board2bits(board)
+        return bitboard_four_in_a_row.has_four(black) or bitboard_four_in_a_row.has_four(white)
+
+    @staticmethod
+    def check_win_action(board, action, player_id=0):
+        black, white = bitboard_four_in_a_row.board2bits(board)
+        mask = black if player_id==four_in_a_row.player1_color else white
+        return bitboard_four_in_a_row.has_four_through(mask, four_in_a_row.action2idx(action))
+
+    @staticmethod
+    def check_draw(board, not_occupied=-1):
+        black, white = bitboard_four_in_a_row.board2bits(board)
+        return (black | white)==bitboard_four_in_a_row.full_mask
+
+    def reset(self):
+        '''Reset the environment, the masks of the state are
+        kept along it'''
+        super().reset()
+        self.bits = self.board2bits(self.board)
+        return self.state
+
+    def step(self, action):
+        '''Take a step in the environment, on the masks kept 
+        by the engine instead of the ones of the board'''
+        next_state, self.bits, reward, done, info = self.bit_transit(self.state, self.bits, action)
+        # an invalid action returns the same state
+        if next_state is not self.state:
+            self.hash = self.zobrist_update(self.hash, action, self.curr_player)
+        self.state = next_state
+        self.board = next_state[0]
+        self.curr_player = next_state[1]
+        return next_state, reward, done, info
+
+    def transit(self, state, action):
+        '''The transition function on the bitboard
+
+        Same rules and outputs as four_in_a_row.transit, the win
+        check only looks at the lines through the new piece. 
+        '''
+        bits = self.board2bits(four_in_a_row.encode(state[0]))
+        next_state, _, reward, done, info = self.bit_transit(state, bits, action)
+        return next_state, reward, done, info
+
+    def bit_transit(self, state, bits, action):
+        '''transit on a state whose (black, white) masks are known
+
+        Outputs:
+            tuple: (next_state, next_bits, reward, done, info), the 
+                same state and masks for an invalid action
+        '''
+        board, curr_player = state
+        x, y = action
+        next_bits, reward, done, info = self.transit_bits(bits, curr_player, x*four_in_a_row.cols+y)
+        if next_bits is bits: return state, bits, reward, done, info
+        board_next = four_in_a_row.encode(board).copy()
+        board_next[x, y] = curr_player
+        return (board_next, 1-curr_player), next_bits, reward, done, info
+
+    @staticmethod
+    def transit_bits(bits, curr_player, idx):
+        '''The transition function on the masks only
+
+        Inputs:
+            bits (tuple): (black, white), the masks of the position
+            curr_player (int): the player to move
+            idx (int): the cell of the action, see action2idx
+
+        Outputs:
+            tuple: (next_bits, reward, done, info), next_bits is 
+                bits itself if the cell is occupied
+        '''
+        black, white = bits
+        reward, done, info = 0, False, {}
+
+        # check if the action is valid
+        if (black | white) & (1 << idx):
+            return bits, reward, done, info
+
+        # update the masks
+        if curr_player==four_in_a_row.player1_color:
+            black |= 1 << idx
+            mover = black
+        else:
+            white |= 1 << idx
+            mover = white
+
+        # check if the game is finished
+        if bitboard_four_in_a_row.has_four_through(mover, idx):
+            done = True
+            reward = four_in_a_row.win_reward
+            winner = 'black' if curr_player==0 else 'white'
+            info = {'winner': winner}
+        elif (black | white)==bitboard_four_in_a_row.full_mask:
+            done = True
+            info = {'winner': 'draw'}
+
+        return (black, white), reward, done, info
+
+    def perft(self, state, depth):
+        '''Count the game tree below a state, see four_in_a_row.perft
+
+        The tree is walked on the masks only, no board is built.
+        '''
+        bits = self.board2bits(four_in_a_row.encode(state[0]))
+        return self.perft_bits(bits, state[1], depth)
+
+    def perft_bits(self, bits, curr_player, depth):
+        nodes, wins, draws = 0, 0, 0
+        if depth==0: return nodes, wins, draws
+        occupied = bits[0] | bits[1]
+        for idx in range(self.n_cells):
+            if (occupied >> idx) & 1: continue
+            next_bits, reward, done, _ = self.transit_bits(bits, curr_player, idx)
+            nodes += 1
+            if done:
+                wins += reward==four_in_a_row.win_reward
+                draws += reward!=four_in_a_row.win_reward
+                continue
+            sub_nodes, sub_wins, sub_draws = self.perft_bits(next_bits, 1-curr_player, depth-1)
+            nodes, wins, draws = nodes+sub_nodes, wins+sub_wins, draws+sub_draws
+        return nodes, wins, draws
+
+# ---------------- Search position ---------------- #
+
+class search_position:
+    '''Mutable position for the tree search
+
+    Instead of copying the board for every child, the search
+    pushes the actions of a line of play onto a single board
+    and pops them to go back. push and pop update the board, 
+    the player to move and the terminal status in place; the
+    undo stack records what is needed to revert each action.
+    The bitboard masks are kept along the board, so the win 
+    check only looks at the lines through the new piece, and
+    the Zobrist hashes of the four orientations are updated 
+    by XOR.
+
+    Inputs:
+        state (tuple): (board, curr_player), the board is copied once
+    '''
+    def __init__(self, state):
+        board, curr_player = state
+        self.board = four_in_a_row.encode(board).copy()
+        self.flat = self.board.reshape(-1)
+        self.curr_player = curr_player
+        self.bits = list(bitboard_four_in_a_row.board2bits(self.board))
+        self.hashes = four_in_a_row.symmetry_hashes(state)
+        self.stack = []
+        # the terminal status of the initial state
+        self.done, self.winner = False, -1
+        for player_id in [four_in_a_row.player1_color, four_in_a_row.player2_color]:
+            if bitboard_four_in_a_row.has_four(self.bits[player_id]):
+                self.done, self.winner = True, player_id
+        if (self.bits[0] | self.bits[1])==bitboard_four_in_a_row.full_mask:
+            self.done = True
+
+    @property
+    def hash(self):
+        '''The Zobrist hash of the position'''
+        return self.hashes[0]
+
+    @property
+    def canonical_hash(self):
+        '''The hash of the equivalence class of the position'''
+        return min(self.hashes)
+
+    @property
+    def state(self):
+        '''The (board, curr_player) tuple, the board is not copied'''
+        return (self.board, self.curr_player)
+    
+    def get_valid_actions(self):
+        if self.done: return []
+        return bitboard_four_in_a_row.legal_actions(*self.bits)
+
+    def push(self, action):
+        '''Drop a piece of the player to move on an empty cell
+
+        Inputs:
+            action (tuple): (row, col), must be a valid action
+        '''
+        idx = four_in_a_row.action2idx(action)
+        player_id = self.curr_player
+        self.stack.append((idx, self.done, self.winner))
+        self.flat[idx] = player_id
+        self.bits[player_id] |= 1 << idx
+        self.update_hashes(player_id, idx)
+        if bitboard_four_in_a_row.has_four_through(self.bits[player_id], idx):
+            self.done, self.winner = True, player_id
+        elif (self.bits[0] | self.bits[1])==bitboard_four_in_a_row.full_mask:
+            self.done = True
+        self.curr_player = 1-player_id
+
+    def pop(self):
+        '''Take back the last pushed action'''
+        idx, self.done, self.winner = self.stack.pop()
+        self.curr_player = 1-self.curr_player
+        self.flat[idx] = four_in_a_row.not_occupied
+        self.bits[self.curr_player] ^= 1 << idx
+        self.update_hashes(self.curr_player, idx)
+
+    @property
+    def threats(self):
+        '''The (black, white) masks of the cells that win at once, 
+        see bitboard_four_in_a_row.threats'''
+        black, white = self.bits
+        empty = bitboard_four_in_a_row.full_mask ^ (black | white)
+        return (bitboard_four_in_a_row.threats(black, empty),
+                bitboard_four_in_a_row.threats(white, empty))
+
+    def perft(self, depth):
+        '''Count the game tree below the position, by push 
+        and pop, see four_in_a_row.perft'''
+        nodes, wins, draws = 0, 0, 0
+        if depth==0: return nodes, wins, draws
+        for action in self.get_valid_actions():
+            self.push(action)
+            nodes += 1
+            if self.done:
+                wins += self.winner!=-1
+                draws += self.winner==-1
+            else:
+                sub_nodes, sub_wins, sub_draws = self.perft(depth-1)
+                nodes, wins, draws = nodes+sub_nodes, wins+sub_wins, draws+sub_draws
+            self.pop()
+        return nodes, wins, draws
+
+    def solve(self, table=None):
+        '''The exact value of the position for the player to move
+
+        Negamax over the whole game tree below the position,
+        for near-full boards. The values are memoized by the 
+        canonical hash: the reflections of a position have
+        the same value.
+
+        Inputs:
+            table (dict): the memo {canonical hash: value}, 
+                filled with every position solved on the way
+
+        Outputs:
+            value (int): 1 win, 0 draw, -1 loss
+        '''
+        if table is None: table = {}
+        h = self.canonical_hash
+        if h in table: return table[h]
+        best = -1
+        for action in self.get_valid_actions():
+            self.push(action)
+            if self.done:
+                value = 1 if self.winner!=-1 else 0
+            else:
+                value = -self.solve(table)
+            self.pop()
+            best = max(best, value)
+            if best==1: break
+        table[h] = best
+        return best
+
+    def update_hashes(self, player_id, idx):
+        '''Add or remove a piece from the hashes, by XOR'''
+        side = four_in_a_row.zobrist_side
+        for t, keys in enumerate(four_in_a_row.symmetry_zobrist):
+            self.hashes[t] ^= keys[player_id][idx] ^ side
 
 
 if __name__ == '__main__':
@@ -0,0 +1,387 @@
+import numpy as np
+from collections import OrderedDict
+from .env_fn import four_in_a_row, directions
+
+# ---------------- Windows ---------------- #
+
+def get_windows(rows, cols, offsets=(-2, -1, 0, 1, 2, 3)):
+    '''The window of each cell along the four directions
+
+    The patterns of the heuristic features of a piece only
+    depend on the cells at offsets -2 to +3 from it, along
+    each direction.
+
+    Outputs:
+        windows (np.ndarray): (rows*cols, 4, 6) the flat indices
+            of the window cells, rows*cols (the index of the
+            off-board cell) if the cell is off the board
+    '''
+    windows = np.full([rows*cols, len(directions), len(offsets)], rows*cols)
+    for r in range(rows):
+        for c in range(cols):
+            for d, (dr, dc) in enumerate(directions):
+                for k, offset in enumerate(offsets):
+                    i, j = r+offset*dr, c+offset*dc
+                    if 0<=i<rows and 0<=j<cols: windows[r*cols+c, d, k] = i*cols+j
+    return windows
+
+def get_cell_windows(windows):
+    '''The windows that contain each cell
+
+    Outputs:
+        cell_windows (np.ndarray): (rows*cols, K) the ids 
+            (cell*4+direction) of the windows that contain the
+            cell, padded with the id of an all off-board window
+    '''
+    n_cells, n_directions, _ = windows.shape
+    flat = windows.reshape([n_cells*n_directions, -1])
+    cell_windows = [np.flatnonzero((flat==i).any(axis=1)) for i in range(n_cells)]
+    width = max(len(ids) for ids in cell_windows)
+    padded = np.full([n_cells, width], n_cells*n_directions)
+    for i, ids in enumerate(cell_windows): padded[i, :len(ids)] = ids
+    return padded
+
+windows = get_windows(four_in_a_row.rows, four_in_a_row.cols)
+cell_windows = get_cell_windows(windows)
+# the flat windows, followed by a window off the board
+window_cells = np.concatenate([windows.reshape([-1, windows.shape[-1]]),
+                               np.full([1, windows.shape[-1]], windows.shape[0])])
+# the value of the cells off the board, neither a piece nor empty
+off_board = 2
+feature_names = ['connected_2_feature', 'unconnected_2_feature',
+                 'connected_3_feature', 'connected_4_feature']
+# the raw features of a player, the inputs of the heuristic
+raw_names = ['center']+feature_names
+# the subsets of the features, bit k of a subset is set if
+# feature_names[k] is kept, e.g. 15 keeps all of them
+n_subsets = 2**len(feature_names)
+subset_masks = (np.arange(n_subsets)[:, None] >> np.arange(len(feature_names))) & 1 == 1
+# the center value of a piece on each cell, and 0 off the board
+center_values = np.append(four_in_a_row.center_values, 0)
+# the feature of each pattern of count_patterns
+pattern_features = np.eye(len(feature_names), dtype=np.int64)[[0, 0, 0, 1, 1, 2, 2, 3]]
+
+# ---------------- Feature counts ---------------- #
+
+def count_patterns(w):
+    '''Count the heuristic patterns of both players in windows
+
+    The patterns of the piece at the center of each window
+    are boolean expressions over the window cells, from 
+    offset -2 to +3:
+        0: prev2, 1: prev, 2: the piece, 3: nxt, 4: nxt2, 5: nxt3
+
+    Inputs:
+        w (np.ndarray): (..., K, 6) the values of the cells of
+            K windows, off_board for the cells off the board
+
+    Outputs:
+        counts (np.ndarray): (..., 2, 4) the counts of black and
+            white over the K windows, see feature_names
+    '''
+    players = np.array([four_in_a_row.player1_color,
+                        four_in_a_row.player2_color]).reshape([2, 1, 1])
+    w = w[..., None, :, :]
+    x = w==players                            # the player's pieces
+    e = w==four_in_a_row.not_occupied         # empty, on the board
+    o = (w!=four_in_a_row.not_occupied) & ~x  # the opponent or off the board
+    x = [x[..., k] for k in range(6)]
+    e = [e[..., k] for k in range(6)]
+    o = [o[..., k] for k in range(6)]
+
+    xx = x[2] & x[3]
+    x_x = x[2] & e[3] & x[4]
+    xxx = xx & x[4]
+    patterns = np.stack([
+        # connected 2: -xx-, xx--, --xx
+        xx & e[1] & e[4], 
+        xx & e[4] & ~o[5] & ~x[1], 
+        xx & e[1] & ~o[0] & ~x[4],
+        # unconnected 2: x-x-, -x-x
+        x_x & e[5] & ~x[1], 
+        x_x & e[1] & ~x[5],
+        # connected 3: xxx-, -xxx
+        xxx & ~o[5] & ~x[1], 
+        xxx & ~o[1] & ~x[5],
+        # connected 4: xxxx, from its first piece
+        xxx & x[5] & ~x[1]], axis=-1)
+    return patterns.sum(axis=-2)@pattern_features
+
+# ---------------- Pattern table ---------------- #
+
+def get_pattern_table(n_window=6):
+    '''The pattern counts of every window, by its base-3 code
+
+    A window is encoded for each player as a base-3 number
+    of its cells, relative to the player: 0 empty, 1 the 
+    player's piece, 2 the opponent's piece or off the board
+    (the patterns do not tell these two apart), the cell k 
+    being the digit of 3**k.
+
+    Outputs:
+        table (np.ndarray): (3**n_window, 4) the counts of the
+            patterns of the player, see count_patterns
+    '''
+    codes = np.arange(3**n_window)
+    digits = (codes[:, None]//3**np.arange(n_window))%3
+    # as a window of black, against white
+    w = np.array([four_in_a_row.not_occupied, four_in_a_row.player1_color,
+                  four_in_a_row.player2_color])[digits]
+    return count_patterns(w[:, None, :])[:, four_in_a_row.player1_color]
+
+pattern_table = get_pattern_table()
+powers = 3**np.arange(windows.shape[-1])
+# the counts of a code packed in one integer, pattern_bits 
+# per feature, so the sum over windows is a single sum (a
+# window counts at most 3 of a feature, 432 on a board)
+pattern_bits = 10
+packed_table = (pattern_table << (pattern_bits*np.arange(len(feature_names)))).sum(axis=1)
+# the base-3 digit of each cell value (empty, black, white, 
+# off board) for black and for white
+cell_digits = np.array([[0, 1, 2, 2], [0, 2, 1, 2]], dtype=np.int16)
+
+def get_digits(flat):
+    '''The base-3 digit of each cell for both players
+
+    Inputs:
+        flat (np.ndarray): (..., cells+1) flat boards with the
+            off-board cell, see extend
+
+    Outputs:
+        digits (np.ndarray): (2, ..., cells+1) the digits of 
+            the cells for black and for white
+    '''
+    return cell_digits[:, flat.astype(np.intp)+1]
+
+def encode_windows(digits, idx):
+    '''The base-3 codes of windows for both players
+
+    Inputs:
+        digits (np.ndarray): (2, ..., cells+1) see get_digits
+        idx (np.ndarray): (..., 6) the cells of the windows
+
+    Outputs:
+        codes (np.ndarray): (2, ...) the code of each window
+            for black and for white, see get_pattern_table; the 
+            board dims of digits followed by the dims of idx
+    '''
+    codes = np.take(digits, idx[..., -1], axis=-1)
+    for k in range(idx.shape[-1]-2, -1, -1):
+        codes = codes*3+np.take(digits, idx[..., k], axis=-1)
+    return codes
+
+def sum_patterns(codes):
+    '''Sum the pattern counts of window codes
+
+    Inputs:
+        codes (np.ndarray): (..., K) the codes of K windows
+
+    Outputs:
+        counts (np.ndarray): (..., 4) the summed counts
+    '''
+    packed = packed_table[codes].sum(axis=-1)
+    shifts = pattern_bits*np.arange(len(feature_names))
+    return (packed[..., None] >> shifts) & ((1 << pattern_bits)-1)
+
+def extend(flat):
+    '''Append the off-board cell to flat boards'''
+    pad = np.full(flat.shape[:-1]+(1,), off_board, dtype=flat.dtype)
+    return np.concatenate([flat, pad], axis=-1)
+
+def get_feature_counts(boards, batch_size=4096):
+    '''The heuristic pattern counts of both players
+
+    The vectorized version of heuristic_agent.get_*_feature:
+    the window of every cell in every direction is gathered
+    for all the boards at once, encoded as base-3 codes and
+    the patterns are read from the pattern table (see 
+    get_pattern_table). The counts are the same as the loops,
+    including a -xx- that is also counted as xx-- and --xx.
+
+    Inputs:
+        boards (np.ndarray): (N, rows, cols) or (rows, cols) boards
+        batch_size (int): the boards gathered at once
+
+    Outputs:
+        counts (np.ndarray): (N, 2, 4) or (2, 4) the counts of
+            black and white, for the features of feature_names
+    '''
+    boards = four_in_a_row.encode(boards)
+    if boards.ndim==2: return get_feature_counts(boards[None], batch_size)[0]
+    n_cells = four_in_a_row.rows*four_in_a_row.cols
+    counts = np.zeros([boards.shape[0], 2, len(feature_names)], dtype=np.int64)
+    for start in range(0, boards.shape[0], batch_size):
+        flat = extend(boards[start:start+batch_size].reshape([-1, n_cells]))
+        codes = encode_windows(get_digits(flat), window_cells[:-1])
+        counts[start:start+batch_size] = np.moveaxis(sum_patterns(codes), 0, 1)
+    return counts
+
+def get_feature_deltas(board, cells, player_id):
+    '''The change of the counts when one piece is dropped
+
+    Only the windows through the new cell can change, so 
+    the counts of a child are the counts of its parent plus
+    the counts of those windows after the move minus their 
+    counts before, for at most 18 windows instead of 144.
+    The codes after the move are the codes before plus the
+    digit of the new piece.
+
+    Inputs:
+        board (np.ndarray): (rows, cols) the parent board
+        cells (np.ndarray): (N,) the flat index of the new 
+            piece of each child, empty cells of the board
+        player_id (int): the player who drops the piece
+
+    Outputs:
+        deltas (np.ndarray): (N, 2, 4) the changes of the 
+            counts of black and white, see get_feature_counts
+    '''
+    flat = extend(four_in_a_row.encode(board).reshape(-1))
+    cells = np.asarray(cells)
+    idx = window_cells[cell_windows[cells]]
+    before = encode_windows(get_digits(flat), idx)
+    # the new cell was empty, digit 0, it adds its digit 
+    # times its power of 3 in each window
+    new_digits = cell_digits[:, player_id+1][:, None, None]
+    after = before+new_digits*((idx==cells[:, None, None])@powers)
+    return np.moveaxis(sum_patterns(after)-sum_patterns(before), 0, 1)
+
+# ---------------- Raw features ---------------- #
+
+def get_center_value(boards):
+    '''The center value of both players
+
+    The sum of 1/distance to the center of the pieces of a
+    player, the dot product of the occupancy mask of the 
+    player with the precomputed values of the cells.
+
+    Inputs:
+        boards (np.ndarray): (N, rows, cols) or (rows, cols) 
+            encoded boards
+
+    Outputs:
+        values (np.ndarray): (N, 2) or (2,) the values of black
+            and white
+    '''
+    flat = boards.reshape(boards.shape[:-2]+(-1,))
+    return np.stack([(flat==player_id)@four_in_a_row.center_values for player_id in 
+                     [four_in_a_row.player1_color, four_in_a_row.player2_color]], axis=-1)
+
+def get_features(boards):
+    '''The raw features of both players
+
+    The inputs of the heuristic that do not depend on the
+    parameters: the center value (the sum of 1/distance to
+    the center of the pieces) and the pattern counts.
+
+    Inputs:
+        boards (np.ndarray): (N, rows, cols) or (rows, cols) boards
+
+    Outputs:
+        features (np.ndarray): (N, 2, 5) or (2, 5) the features
+            of black and white, see raw_names
+    '''
+    boards = four_in_a_row.encode(boards)
+    counts = get_feature_counts(boards)
+    return np.concatenate([get_center_value(boards)[..., None], counts], axis=-1)
+
+def get_child_features(board, features, cells, player_id):
+    '''The raw features of the children of a board
+
+    Inputs:
+        board (np.ndarray): (rows, cols) the parent board
+        features (np.ndarray): (2, 5) the features of the parent
+        cells (np.ndarray): (N,) the flat index of the new 
+            piece of each child
+        player_id (int): the player who drops the piece
+
+    Outputs:
+        features (np.ndarray): (N, 2, 5) see get_features
+    '''
+    cells = np.asarray(cells)
+    deltas = np.zeros([len(cells), 2, len(raw_names)])
+    deltas[:, player_id, 0] = center_values[cells]
+    deltas[:, :, 1:] = get_feature_deltas(board, cells, player_id)
+    return features+deltas
+
+# ---------------- Feature cache ---------------- #
+
+class feature_cache:
+    '''LRU cache of the raw features of the positions
+
+    The features do not depend on the parameters, so during
+    a fit the features of the dataset positions, and of the
+    positions searched from them, are computed once and only
+    the weights change. The keys are the Zobrist hashes of 
+    the boards (see board_key), the features hold the counts
+    of both players.
+
+    With a store, e.g. data_fn.feature_db, the positions 
+    missing from memory are looked up in the store, and the
+    computed ones are added to it.
+
+    Inputs:
+        max_size (int): the most positions kept, the least
+            recently used are evicted first
+        store (object): optional, with get_many(keys), which
+            returns a dict of the keys found, and 
+            put_many(keys, features)
+    '''
+    def __init__(self, max_size=2**17, store=None):
+        self.max_size = max_size
+        self.store = store
+        self.data = OrderedDict()
+        self.hits, self.store_hits, self.misses = 0, 0, 0
+
+    def __len__(self):
+        return len(self.data)
+
+    @staticmethod
+    def board_key(h, curr_player):
+        '''The key of a board from the hash of its state, the
+        features do not depend on the player to move'''
+        return h ^ four_in_a_row.zobrist_side if curr_player==four_in_a_row.player2_color else h
+
+    def get_many(self, keys, compute_fn):
+        '''The features of a batch of positions
+
+        Inputs:
+            keys (list): the keys of the positions
+            compute_fn (callable): computes the features of the
+                positions missing from the cache, given their 
+                indices in keys as an np.ndarray
+
+        Outputs:
+            features (np.ndarray): (N, 2, 5) see get_features
+        '''
+        features, missing = [None]*len(keys), []
+        for i, key in enumerate(keys):
+            value = self.data.get(key)
+            if value is None:
+                missing.append(i)
+            else:
+                self.data.move_to_end(key)
+                features[i] = value
+        self.hits += len(keys)-len(missing)
+        if len(missing) and self.store is not None:
+            found = self.store.get_many([keys[i] for i in missing])
+            for i in missing:
+                if keys[i] in found: features[i] = self.data[keys[i]] = found[keys[i]]
+            self.store_hits += len(found)
+            missing = [i for i in missing if features[i] is None]
+        self.misses += len(missing)
+        if len(missing):
+            computed = compute_fn(np.array(missing))
+            for i, value in zip(missing, computed):
+                # a copy, a view would keep the whole batch alive
+                features[i] = self.data[keys[i]] = np.array(value)
+            if self.store is not None: self.store.put_many([keys[i] for i in missing], computed)
+        while len(self.data)>self.max_size: self.data.popitem(last=False)
+        return np.stack(features)
+
+    def stats(self):
+        '''The size and the hit rate of the cache, the store
+        hits count as hits'''
+        n = self.hits+self.store_hits+self.misses
+        return {'size': len(self), 'hits': self.hits, 'store_hits': self.store_hits,
+                'misses': self.misses, 'hit_rate': (self.hits+self.store_hits)/n if n else 0.}
@@ -2,14 +2,17 @@ import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+from .env_fn import four_in_a_row
 
 def layout2board(layout):
     return np.array([[0.75 if c == '.' else 0 if c == '0' else 1. for c in row] for row in layout])
 
 def board2layout(board):
+    board = four_in_a_row.decode(board)
     return [''.join(['.' if x==0.75 else '0' if x==0 else '1' for x in row]) for row in board]
 
 def show_board(board, p_actions={}, not_occupied=0.75):
+    board = four_in_a_row.decode(board)
     rows, cols = board.shape
     empty_board = np.ones([rows, cols])*not_occupied
     # Draw filled scatter points on non-empty grids
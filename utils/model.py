@@ -1,9 +1,11 @@
 import os
-import pickle
 import numpy as np 
 from copy import deepcopy
 from pyibs import IBS
 from .env_fn import *
+from .feature_fn import get_features, get_child_features, feature_names, feature_cache, \
+    n_subsets, subset_masks
+from .data_fn import feature_db
 
 
 pth = os.path.dirname(os.path.abspath(__file__))
@@ -72,10 +74,125 @@ class queue:
             return self.elements.pop(0)
         return None
 
+class random_stream:
+    '''The random numbers of an agent
+
+    numpy Generators on a counter-based bit generator 
+    (Philox), keyed from a SeedSequence. The stream of a 
+    trial is a position of the counter, so restarting it
+    does not build new generators. The normal and uniform
+    draws are taken from blocks drawn at once, so the search
+    pays the cost of the Generator once per block and not 
+    once per node. The draws do not depend on how they are
+    grouped: n calls to normal() give the values of one 
+    call to normal(n).
+
+    Inputs:
+        seed (int, list or np.random.SeedSequence): the seed
+            of the stream, fresh entropy if None
+        block_size (int): the largest block of draws
+    '''
+    kinds = ['normal', 'uniform']
+    min_block = 32
+
+    def __init__(self, seed=None, block_size=1024):
+        self.block_size = block_size
+        self.root = seed if isinstance(seed, np.random.SeedSequence) \
+                        else np.random.SeedSequence(seed)
+        # one generator per kind of draw, so the draws of a kind
+        # do not depend on the draws of the other
+        self.key = self.root.generate_state(2, np.uint64)
+        self.bit_generators = {kind: np.random.Philox(key=self.key) for kind in self.kinds}
+        self.generators = {kind: np.random.Generator(bg) for kind, bg in self.bit_generators.items()}
+        # the draws of each kind in the last trial, the size 
+        # of the first block of the next trial
+        self.n_draws = {kind: 0 for kind in self.kinds}
+        self.last_draws = {kind: self.min_block for kind in self.kinds}
+        self.n_calls = 0
+        self.reset()
+
+    def reset(self, trial=None):
+        '''Restart the draws at the stream of a trial (see 
+        trial_seeds), or at the main stream if None'''
+        for kind in self.kinds:
+            if self.n_draws[kind]: self.last_draws[kind] = max(self.n_draws[kind], self.min_block)
+            self.n_draws[kind] = 0
+        # the counter of the generators is [draw, kind, trial, 
+        # call], the call is 0 on the main stream; it is set on
+        # the first block of a kind, see refill
+        self.trial = (0, 0) if trial is None else (trial[1], trial[0]+1)
+        # the blocks, and their lists for the scalar draws, made
+        # on the first scalar draw of a block
+        self.blocks = {kind: np.empty(0) for kind in self.kinds}
+        self.lists = {kind: [] for kind in self.kinds}
+        self.pos = {kind: 0 for kind in self.kinds}
+
+    def spawn(self, n):
+        '''n independent streams, e.g. one per worker process'''
+        return [random_stream(seed_seq, self.block_size) for seed_seq in self.root.spawn(n)]
+
+    def trial_seeds(self, n):
+        '''The seeds of the n trials of a call, see reset
+
+        The stream of a trial only depends on the root seed, 
+        the number of calls before and the trial position, 
+        not on the process that runs it.
+        '''
+        seeds = [(self.n_calls, i) for i in range(n)]
+        self.n_calls += 1
+        return seeds
+
+    def refill(self, kind, n):
+        '''Start a new block, after the remaining draws'''
+        block, pos = self.blocks[kind], self.pos[kind]
+        if self.n_draws[kind]==0 and len(block)==0:
+            # the first block of the trial, about the draws of the last one
+            counter = np.array([0, self.kinds.index(kind), *self.trial], dtype=np.uint64)
+            self.bit_generators[kind].state = {
+                'bit_generator': 'Philox', 'state': {'counter': counter, 'key': self.key},
+                'buffer': np.zeros(4, dtype=np.uint64), 'buffer_pos': 4, 'has_uint32': 0, 'uinteger': 0}
+            size = self.last_draws[kind]
+        else:
+            size = min(2*len(block), self.block_size)
+        new_block = getattr(self.generators[kind], 'standard_normal' if kind=='normal' 
+                            else 'random')(max(size, n))
+        self.blocks[kind] = np.concatenate([block[pos:], new_block]) if pos<len(block) else new_block
+        self.lists[kind] = None
+        self.pos[kind] = 0
+
+    def draw(self, kind, n):
+        if self.pos[kind]+n>len(self.blocks[kind]): self.refill(kind, n)
+        pos = self.pos[kind]
+        self.pos[kind] = pos+n
+        self.n_draws[kind] += n
+        return self.blocks[kind][pos:pos+n]
+
+    def draw_one(self, kind):
+        pos, values = self.pos[kind], self.lists[kind]
+        if pos>=len(self.blocks[kind]): 
+            self.refill(kind, 1)
+            pos, values = 0, None
+        if values is None: values = self.lists[kind] = self.blocks[kind].tolist()
+        self.pos[kind] = pos+1
+        self.n_draws[kind] += 1
+        return values[pos]
+
+    def normal(self, n=None):
+        '''Standard normal draws, a float if n is None'''
+        return self.draw_one('normal') if n is None else self.draw('normal', n)
+
+    def uniform(self, n=None):
+        '''Uniform draws in [0, 1), a float if n is None'''
+        return self.draw_one('uniform') if n is None else self.draw('uniform', n)
+
+    def integers(self, high):
+        '''A uniform integer in [0, high)'''
+        return int(self.uniform()*high)
+
 class Node:
 
     def __init__(self, state, action=None, parent=None, depth=0,
-                 value=None, heuristic_fn=None):
+                 value=None, heuristic_fn=None, player=None, features=None):
         '''Node for a tree search
 
         The basic element in the tree search.
@@ -83,20 +200,41 @@ class Node:
         together, due to that the four in a row enviorment
         is deterministic.
 
+        Nodes expanded on a search position do not keep
+        a board (state=None): their state is the root state 
+        followed by the actions on the path to the node.
+
         Inputs:
-            state: tuple (board, player_id):
+            state: tuple (board, player_id), or None
             action: tuple (row, col)
             parent: node
             depth: int
+            value: float, used when heuristic_fn is None
+            player: int, the player to move when state is None
+            features: np.ndarray (2, 5), the raw features of the
+                node, computed on the first expansion if None
         '''
         # basic info 
         self.state     = state
         self.action    = action
+        self.player    = state[1] if state is not None else player
         # tree info 
         self.parent    = parent
         self.children  = []
-        self.value     = heuristic_fn(state) if heuristic_fn is not None else 0
+        if heuristic_fn is not None: 
+            self.value = heuristic_fn(state)
+        else:
+            self.value = value if value is not None else 0
         self.depth     = depth
+        self.features  = features
+
+    def path(self):
+        '''The root node and the actions from the root to this node'''
+        node, actions = self, []
+        while node.parent is not None:
+            actions.append(node.action)
+            node = node.parent
+        return node, actions[::-1]
         
 class default_params:
     ''' Default parameters for the van plan agent
@@ -121,9 +259,17 @@ class default_params:
 
 class basic_agent:
 
-    def __init__(self, env, params):
+    # whether get_action takes the raw features of the state
+    reads_features = False
+
+    def __init__(self, env, params, seed=None):
         self.env = env
         self.load_params(params)
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        '''Restart the random stream of the agent (see random_stream)'''
+        self.rng = seed if isinstance(seed, random_stream) else random_stream(seed)
 
     def load_params(self, params: list):
         raise NotImplementedError
@@ -133,8 +279,17 @@ class basic_agent:
     
     def response_generator(self, params:list, design: np.array):
         self.load_params(params)
-        state_lst = [self.env.embed(d) for d in design]
-        action_lst = list(map(self.get_action, state_lst))
+        design = np.asarray(design)
+        boards, players = self.env.embed_many(design)
+        # the raw features of the roots, from the feature table of the dataset 
+        features = self.env.embed_features(design) if self.reads_features else None
+        action_lst = []
+        for i, seed_seq in enumerate(self.rng.trial_seeds(len(design))):
+            # each trial has its own stream, see random_stream.trial_seeds
+            self.rng.reset(seed_seq)
+            state = (boards[i], int(players[i]))
+            if features is None: action_lst.append(self.get_action(state))
+            else: action_lst.append(self.get_action(state, features[i]))
         return np.array([self.env.action2idx(action) for action in action_lst])
         
     def heuristic(self, state: tuple):
@@ -147,6 +302,15 @@ class heuristic_agent(basic_agent):
 
     The heuristic agent make decision based on pure 
     heuristic evaluation of the state
+
+    With an endgame table (see data_fn.endgame_table), the
+    positions found in the table, and the ends of the games,
+    are valued exactly (+/- win_value) instead of by the 
+    heuristic.
+
+    The raw features of the positions it evaluates are kept
+    in an LRU cache (see feature_cache), so changing the 
+    parameters, e.g. during a fit, only redoes the weighting.
     '''
     name = 'heuristic_agent'
     p_names = ['lmbda', 'gamma', 'theta', 'delta', 'C', 
@@ -156,9 +320,16 @@ class heuristic_agent(basic_agent):
     p_pbnds = [(.05, .5), (.1, .9), (.2, 8), (.001, .5), (.5, 2), 
                (-5, 5), (-5, 5), (-5, 5), (-5, 5), (-5, 5)]
     n_params = len(p_names)
+    win_value = 10000
+    # the roots are valued from their raw features, see get_action
+    reads_features = True
 
-    def __init__(self, env, params):
-        super().__init__(env, params)
+    def __init__(self, env, params, endgame=None, cache_size=2**17, seed=None):
+        super().__init__(env, params, seed)
+        self.endgame = endgame
+        # the raw features of the positions, kept across
+        # parameters, none if cache_size is 0
+        self.cache = feature_cache(cache_size) if cache_size else None
         self.define_features()
 
     def load_params(self, params: list):
@@ -172,6 +343,10 @@ class heuristic_agent(basic_agent):
         self.w_u2  = params[7] # unconnected 2 
         self.w_c3  = params[8] # connected 3 
         self.w_c4  = params[9] # connected 4 
+        # the weights of the raw features for each subset of the
+        # features, the dropped features have no weight
+        weights = np.array([self.w_ce, self.w_c2, self.w_u2, self.w_c3, self.w_c4])
+        self.subset_weights = weights*np.hstack([np.ones([n_subsets, 1]), subset_masks])
     
     def define_features(self):
         self.features = [
@@ -181,50 +356,130 @@ class heuristic_agent(basic_agent):
             'connected_4_feature'
         ]
 
-    def get_action(self, state: tuple):
+    @property
+    def features(self):
+        '''The names of the features in use'''
+        return [name for name, kept in zip(feature_names, subset_masks[self.subset]) if kept]
+
+    @features.setter
+    def features(self, names):
+        # the features in use are a bitmask, see feature_fn.subset_masks
+        self.subset = sum(1<<k for k, name in enumerate(feature_names) if name in names)
+
+    def get_action(self, state: tuple, features=None):
         '''greedy policy based on heuristic evaluation
 
         Inputs:
             state: a tuple (board, player_id)
+            features: np.ndarray (2, 5), the raw features of 
+                the board if known, see get_features
         
         Outputs:
             action: a tuple (row, col)
         '''
+        state = (self.env.encode(state[0]), state[1])
         self.player_id  = state[1]
         self.opponent_id = 1-self.player_id
+        self.position = self.env.position(state)
         # build the root node
+        if features is None: features = self.root_features()
         root = Node(state=state, 
                     parent=None, 
-                    heuristic_fn=self.heuristic,
-                    depth=0)
+                    value=self.heuristic_many(None, state[1], features[None])[0],
+                    depth=0,
+                    features=features)
         # expand all root
         self.expand_node(root)
         # choose the best action based on the minimax algorithm
         return self.minmax(root).action
     
+    def root_features(self):
+        '''The raw features of the search position, read from
+        the feature cache, see get_features'''
+        return self.get_features(self.position.board, [self.position.hash], self.position.curr_player, 
+                                 lambda _: get_features(self.position.board)[None])[0]
+
     def expand_node(self, node):
-        state = node.state
-        valid_actions = self.env.get_valid_actions(state[0])
+        '''Expand the node on the search position
+
+        The actions from the root to the node are pushed
+        on self.position, and the children are evaluated in 
+        one call to heuristic_many. The raw features of a 
+        child are those of the node plus the change of the 
+        windows through its new piece, or are read from the
+        feature cache.
+        '''
+        _, path = node.path()
+        for action in path: self.position.push(action)
+        valid_actions = self.position.get_valid_actions()
         if len(valid_actions)>0:
+            # the children, evaluated at once
+            player = self.position.curr_player
+            cells = np.array([self.env.action2idx(a) for a in valid_actions])
+            if node.features is None: node.features = self.root_features()
+            keys = [self.position.hash ^ self.env.zobrist[player][c] ^ self.env.zobrist_side for c in cells]
+            features = self.get_features(self.position.board, keys, 1-player, 
+                            lambda missing: get_child_features(self.position.board, 
+                                                node.features, cells[missing], player))
+            values = self.heuristic_many(None, 1-player, features)
             # expand the node throught breadth first search
-            for action in valid_actions:
-                # this deepcopy is important
-                # as the transit function will modify the state
-                # we need to keep the original state for the parent node
-                # otherwise, the state will be modified
-                state_next, _, done, info = self.env.transit(deepcopy(state), action)
+            for action, value, features in zip(valid_actions, values.tolist(), features):
+                if self.endgame is not None:
+                    self.position.push(action)
+                    exact_value = self.exact_value()
+                    if exact_value is not None: value = exact_value
+                    self.position.pop()
                 child_node = Node(
-                    state=state_next, 
+                    state=None, 
                     action=action, 
                     parent=node, 
-                    heuristic_fn=self.heuristic,
-                    depth=node.depth+1
+                    value=value,
+                    player=1-player,
+                    depth=node.depth+1,
+                    features=features
                 )
                 node.children.append(child_node)
             # get the max value of the children
             max_value = self.minmax(node).value
             # prune the low value children
             node.children = [child for child in node.children if np.abs(child.value-max_value)<=self.theta]
+        # back to the root
+        for _ in path: self.position.pop()
+
+    def get_features(self, board, hashes, player_to_move, compute_fn):
+        '''The raw features of positions, through the cache
+
+        Inputs:
+            board: the board of self.position
+            hashes: list, the Zobrist hashes of the positions
+            player_to_move: int, the player to move in them
+            compute_fn: callable, computes the features of the
+                positions at the given indices
+
+        Outputs:
+            features: np.ndarray (N, 2, 5)
+        '''
+        if self.cache is None: return compute_fn(np.arange(len(hashes)))
+        keys = [feature_cache.board_key(h, player_to_move) for h in hashes]
+        return self.cache.get_many(keys, compute_fn)
+
+    def exact_value(self):
+        '''The exact value of self.position for self.player_id
+
+        Outputs:
+            value (float): +/- win_value or 0, None if the 
+                game is not over and not in the endgame table
+        '''
+        position = self.position
+        if position.done:
+            if position.winner==-1: return 0
+            value = 1 if position.winner==self.player_id else -1
+        else:
+            value = self.endgame.lookup(position.canonical_hash)
+            if value is None: return None
+            # the table values are for the player to move
+            if position.curr_player!=self.player_id: value = -value
+        return value*self.win_value
     
     def minmax(self, node: Node):
         '''Minimax algorithm
@@ -244,7 +499,7 @@ class heuristic_agent(basic_agent):
         # if the node is a leaf node, return the node
         if len(node.children) == 0: return node
         # if it is the player's turn, choose the child with the highest value
-        if self.player_id==node.state[1]:
+        if self.player_id==node.player:
             best_node, best_value = None, -np.inf
             for child in node.children:
                 if child.value > best_value:
@@ -294,21 +549,24 @@ class heuristic_agent(basic_agent):
         '''
         # get the board and player id 
         board, id_to_move = state
-        player_pieces = np.vstack(np.where(board==self.player_id)).T
+        # the occupancy masks of the flat board
+        flat = board.ravel()
+        player_mask = flat==self.player_id
+        player_pieces = self.env.cell_coords[player_mask]
         C_player = 1 if id_to_move==self.player_id else self.C
         # the opponent id 
         opponent_id = int(1-self.player_id)
-        opponent_pieces = np.vstack(np.where(board==opponent_id)).T
+        opponent_mask = flat==opponent_id
+        opponent_pieces = self.env.cell_coords[opponent_mask]
         C_opponent = 1 if id_to_move==self.opponent_id else self.C
         
-        # get the center value
-        value_center = self.get_center_value(self.env.center, 
-                                             player_pieces, 
-                                             opponent_pieces)
+        # get the center value, from the values of the cells
+        value_center = self.env.center_values@player_mask \
+                        - self.env.center_values@opponent_mask
         
         # get the connected 2-in-a-row value
         feature_c2 = 0
-        if 'connected_2_feature' in self.features:
+        if self.subset & 1:
             if verbose: print('\n connected 2-in-a-row:')
             if verbose: print('player:')
             f_c2_player = self.get_connected_2_feature(board, player_pieces, verbose=verbose)
@@ -318,7 +576,7 @@ class heuristic_agent(basic_agent):
         
         # get the unconnected 2-in-a-row value
         feature_u2 = 0
-        if 'unconnected_2_feature' in self.features:
+        if self.subset & 2:
             if verbose: print('\n unconnected 2-in-a-row:')
             if verbose: print('player:')
             f_u2_player = self.get_unconnected_2_feature(board, player_pieces, verbose=verbose)
@@ -328,7 +586,7 @@ class heuristic_agent(basic_agent):
         
         # get the connected 3-in-a-row value
         feature_c3 = 0
-        if 'connected_3_feature' in self.features:
+        if self.subset & 4:
             if verbose: print('\n connected 3-in-a-row:')
             if verbose: print('player:')
             f_c3_player = self.get_connected_3_feature(board, player_pieces, verbose=verbose)
@@ -338,7 +596,7 @@ class heuristic_agent(basic_agent):
             
         # get the connected 4-in-a-row value
         feature_c4 = 0
-        if 'connected_4_feature' in self.features:
+        if self.subset & 8:
             if verbose: print('\n connected 4-in-a-row:')
             if verbose: print('player:')
             f_c4_player = self.get_connected_4_feature(board, player_pieces, verbose=verbose)
@@ -347,7 +605,7 @@ class heuristic_agent(basic_agent):
             feature_c4 = C_player*f_c4_player - C_opponent*f_c4_opponent
 
         # combine the value   
-        noise = np.random.randn() 
+        noise = self.rng.normal()
         value = self.w_ce * value_center \
                     + self.w_c2 * feature_c2 \
                     + self.w_u2 * feature_u2 \
@@ -357,6 +615,43 @@ class heuristic_agent(basic_agent):
         
         return value
     
+    def heuristic_many(self, boards, player_to_move, features=None):
+        '''Heuristic evaluation of a stack of boards
+
+        The same value as heuristic, for N boards in one call:
+        the raw features of all the boards (see feature_fn),
+        which do not depend on the parameters, a matrix-vector
+        product with the weights, and one vector of N noise 
+        draws, in the order heuristic would draw them board 
+        by board.
+
+        Inputs:
+            boards: np.ndarray (N, rows, cols), or None if the
+                features are given
+            player_to_move: int or np.ndarray (N,)
+            features: np.ndarray (N, 2, 5), the raw features of 
+                the boards if known, see get_features
+
+        Outputs:
+            values: np.ndarray (N,)
+        '''
+        if features is None: features = get_features(self.env.encode(boards))
+        n = features.shape[0]
+        player_to_move = np.broadcast_to(player_to_move, [n])
+        # the center term is not scaled by C
+        C_player = np.where(player_to_move==self.player_id, 1, self.C)
+        C_opponent = np.where(player_to_move==self.opponent_id, 1, self.C)
+        scale = np.ones([n, 2, features.shape[2]])
+        scale[:, 0, 1:] = C_player[:, None]
+        scale[:, 1, 1:] = C_opponent[:, None]
+        features = scale[:, 0]*features[:, self.player_id] \
+                    - scale[:, 1]*features[:, self.opponent_id]
+        # the dropped features have no weight
+        weights = self.subset_weights[self.subset]
+
+        noise = self.rng.normal(n)
+        return features@weights + noise
+
     @staticmethod
     def get_center_value(center, player_pieces, opponent_pieces):
         '''Estimate whose pieces are closer to the center
@@ -364,18 +659,29 @@ class heuristic_agent(basic_agent):
          V = sum_{i in player_pieces} 1/||i-center_coord|| 
                 - sum_{j in opponent_pieces} 1/||j-center_coord||
 
+        The values of the cells are precomputed for the center
+        of the board (four_in_a_row.center_values), see also 
+        feature_fn.get_center_value for boards.
+
         Inputs:
-            state: tuple (board, player_id)
+            center: np.ndarray, the center of the board
+            player_pieces: np.ndarray (K, 2), the coordinates of
+                the player's pieces
+            opponent_pieces: np.ndarray (K, 2)
 
         Outputs:
             value: float
         '''
+        if np.array_equal(center, four_in_a_row.center):
+            cols = four_in_a_row.cols
+            return four_in_a_row.center_values[np.dot(player_pieces, [cols, 1])].sum() \
+                    - four_in_a_row.center_values[np.dot(opponent_pieces, [cols, 1])].sum()
         player_dists = np.linalg.norm(player_pieces-center, axis=1)
         opponent_dists = np.linalg.norm(opponent_pieces-center, axis=1)
         return (1/player_dists).sum() - (1/opponent_dists).sum()
     
     @staticmethod
-    def get_connected_2_feature(board, player_pieces, not_occupied=.75, verbose=False):
+    def get_connected_2_feature(board, player_pieces, not_occupied=-1, verbose=False):
         '''Calculate the number of connected 2-in-a-row features
         
         Consider these three patterns:
@@ -388,7 +694,7 @@ class heuristic_agent(basic_agent):
         Inputs:
             board: numpy array
             player_pieces: numpy array, the coordinates of the player's pieces
-            not_occupied: value representing empty spaces (default: .75)
+            not_occupied: value representing empty spaces (default: -1)
             verbose: bool, whether to print debug information
             
         Outputs:
@@ -399,91 +705,54 @@ class heuristic_agent(basic_agent):
         
         rows, cols = board.shape
         count = 0
+        direction_names = ['horizontal', 'vertical', 'diagonal1', 'diagonal2']
         
-        # Directions to check: horizontal, vertical, diagonal1, diagonal2
-        directions = [(0, 1), (1, 0), (1, 1), (1, -1)]
-        direction_names = {(0, 1): 'horizontal', 
-                           (1, 0): 'vertical', 
-                           (1, 1): 'diagonal1', 
-                           (1,-1): 'diagonal2'}
-        
-        # Create a set of player piece coordinates for faster lookup
-        piece_set = set(map(tuple, player_pieces))
+        # the flattened board and the precomputed neighbors
+        # of each cell in the four directions
+        flat = board.ravel().tolist()
+        neighbors = four_in_a_row.neighbors
         player_color = int(board[player_pieces[0][0], player_pieces[0][1]])
         opponent_color = 1-player_color
         
-        # To avoid double counting
-        counted_features = set()
-        
         # return 1 if a connected 2-in-a-row is found 
         # for each location (r,c) with orientation (dr, dc)
-        # and 0 otherwise 
+        # and 0 otherwise. -1 marks a cell off the board
         for r, c in player_pieces:
-            for dr, dc in directions:
+            for d, (prev2, prev, nxt, nxt2, nxt3) in enumerate(neighbors[r*cols+c]):
                 # Check if there's a connected piece next to current piece
-                next_r, next_c = r + dr, c + dc
-                if (next_r, next_c) not in piece_set:
+                if nxt < 0 or flat[nxt] != player_color:
                     continue
-                    
-                # Get coordinates for checking patterns
-                prev_r, prev_c = r - dr, c - dc
-                next2_r, next2_c = next_r + dr, next_c + dc
-                next3_r, next3_c = next2_r + dr, next2_c + dc
-                prev2_r, prev2_c = prev_r - dr, prev_c - dc
-                
-                # Check if coordinates are within bounds
-                next2_valid = 0 <= next2_r < rows and 0 <= next2_c < cols
-                next3_valid = 0 <= next3_r < rows and 0 <= next3_c < cols
-                prev_valid = 0 <= prev_r < rows and 0 <= prev_c < cols
-                prev2_valid = 0 <= prev2_r < rows and 0 <= prev2_c < cols
-                
-                # Create feature key for deduplication
-                feature_key = None
-                pattern = None
                 
                 # Check -xx- pattern
-                if (prev_valid and next2_valid and
-                      board[prev_r, prev_c] == not_occupied and
-                      board[next2_r, next2_c] == not_occupied):
-                    feature_key = (r, c, dr, dc)
-                    pattern = "-xx-"
+                if (prev >= 0 and nxt2 >= 0 and
+                      flat[prev] == not_occupied and
+                      flat[nxt2] == not_occupied):
                     if verbose:
-                        print(f'{r}, {c}: {direction_names[(dr, dc)]}, pattern: {pattern}')
+                        print(f'{r}, {c}: {direction_names[d]}, pattern: -xx-')
                     count += 1
                 
                 # Check xx-- pattern
-                if (next2_valid and next3_valid and
-                    board[next2_r, next2_c] == not_occupied and
-                    board[next3_r, next3_c] != opponent_color and
-                    (not prev_valid or board[prev_r, prev_c] != player_color)):
-                    feature_key = (r, c, dr, dc)
-                    pattern = "xx--"
+                if (nxt2 >= 0 and nxt3 >= 0 and
+                    flat[nxt2] == not_occupied and
+                    flat[nxt3] != opponent_color and
+                    (prev < 0 or flat[prev] != player_color)):
                     if verbose:
-                        print(f'{r}, {c}: {direction_names[(dr, dc)]}, pattern: {pattern}')
+                        print(f'{r}, {c}: {direction_names[d]}, pattern: xx--')
                     count += 1
                 
                 # Check --xx pattern
-                if (prev_valid and prev2_valid and
-                      board[prev_r, prev_c] == not_occupied and
-                      board[prev2_r, prev2_c] != opponent_color and
-                      (not next2_valid or board[next2_r, next2_c] != player_color)):
-                    feature_key = (prev2_r, prev2_c, dr, dc)
-                    pattern = "--xx"
+                if (prev >= 0 and prev2 >= 0 and
+                      flat[prev] == not_occupied and
+                      flat[prev2] != opponent_color and
+                      (nxt2 < 0 or flat[nxt2] != player_color)):
                     if verbose:
-                        print(f'{r}, {c}: {direction_names[(dr, dc)]}, pattern: {pattern}')
+                        print(f'{r}, {c}: {direction_names[d]}, pattern: --xx')
                     count += 1
-                
-                # # If we found a pattern and haven't counted it yet
-                # if feature_key and feature_key not in counted_features:
-                #     counted_features.add(feature_key)
-                #     if verbose:
-                #         print(f'{r}, {c}: {direction_names[(dr, dc)]}, pattern: {pattern}')
-                #     count += 1
         
         return count
     
     @staticmethod
-    def get_unconnected_2_feature(board, player_pieces, not_occupied=.75, verbose=False):
+    def get_unconnected_2_feature(board, player_pieces, not_occupied=-1, verbose=False):
         '''Calculate the number of unconnected 2-in-a-row features
         
         Consider these two patterns:
@@ -496,7 +765,7 @@ class heuristic_agent(basic_agent):
         Inputs:
             board: numpy array
             player_pieces: numpy array, the coordinates of the player's pieces
-            not_occupied: value representing empty spaces (default: .75)
+            not_occupied: value representing empty spaces (default: -1)
             verbose: bool, whether to print debug information
             
         Outputs:
@@ -507,77 +776,43 @@ class heuristic_agent(basic_agent):
         
         rows, cols = board.shape
         count = 0
+        direction_names = ['horizontal', 'vertical', 'diagonal1', 'diagonal2']
         
-        # Directions to check: horizontal, vertical, diagonal1, diagonal2
-        directions = [(0, 1), (1, 0), (1, 1), (1, -1)]
-        direction_names = {(0, 1): 'horizontal', 
-                           (1, 0): 'vertical', 
-                           (1, 1): 'diagonal1', 
-                           (1,-1): 'diagonal2'}
-        
-        # Create a set of player piece coordinates for faster lookup
-        piece_set = set(map(tuple, player_pieces))
+        # the flattened board and the precomputed neighbors
+        # of each cell in the four directions
+        flat = board.ravel().tolist()
+        neighbors = four_in_a_row.neighbors
         player_color = board[player_pieces[0][0], player_pieces[0][1]]
         
-        # To avoid double counting
-        counted_features = set()
-        
         # return 1 if a unconnected 2-in-a-row is found 
         # for each location (r,c) with orientation (dr, dc)
-        # and 0 otherwise 
+        # and 0 otherwise. -1 marks a cell off the board
         for r, c in player_pieces:
-            for dr, dc in directions:
-                # Get coordinates for checking patterns
-                next_r, next_c = r + dr, c + dc
-                next2_r, next2_c = next_r + dr, next_c + dc
-                next3_r, next3_c = next2_r + dr, next2_c + dc
-                prev_r, prev_c = r - dr, c - dc
-                
-                # Check if coordinates are within bounds
-                next_valid = 0 <= next_r < rows and 0 <= next_c < cols
-                next2_valid = 0 <= next2_r < rows and 0 <= next2_c < cols
-                next3_valid = 0 <= next3_r < rows and 0 <= next3_c < cols
-                prev_valid = 0 <= prev_r < rows and 0 <= prev_c < cols
-                
-                # Create feature key for deduplication
-                feature_key = None
-                pattern = None
-                
+            for d, (prev2, prev, nxt, nxt2, nxt3) in enumerate(neighbors[r*cols+c]):
                 # Check x-x- pattern
-                if (next_valid and next2_valid and
-                    board[next_r, next_c] == not_occupied and
-                    (next2_r, next2_c) in piece_set and
-                    (next3_valid and board[next3_r, next3_c] == not_occupied) and
-                    (not prev_valid or board[prev_r, prev_c] != player_color)):
-                    feature_key = (r, c, dr, dc)
-                    pattern = "x-x-"
+                if (nxt >= 0 and nxt2 >= 0 and
+                    flat[nxt] == not_occupied and
+                    flat[nxt2] == player_color and
+                    (nxt3 >= 0 and flat[nxt3] == not_occupied) and
+                    (prev < 0 or flat[prev] != player_color)):
                     if verbose:
-                        print(f'{r}, {c}: {direction_names[(dr, dc)]}, pattern: {pattern}')
+                        print(f'{r}, {c}: {direction_names[d]}, pattern: x-x-')
                     count += 1
                 
                 # Check -x-x pattern
-                if (prev_valid and next_valid and
-                      board[prev_r, prev_c] == not_occupied and
-                      board[next_r, next_c] == not_occupied and
-                      (next2_r, next2_c) in piece_set and
-                      (not next3_valid or board[next3_r, next3_c] != player_color)):
-                    feature_key = (r, c, dr, dc)
-                    pattern = "-x-x"
+                if (prev >= 0 and nxt >= 0 and nxt2 >= 0 and
+                      flat[prev] == not_occupied and
+                      flat[nxt] == not_occupied and
+                      flat[nxt2] == player_color and
+                      (nxt3 < 0 or flat[nxt3] != player_color)):
                     if verbose:
-                        print(f'{r}, {c}: {direction_names[(dr, dc)]}, pattern: {pattern}')
+                        print(f'{r}, {c}: {direction_names[d]}, pattern: -x-x')
                     count += 1
-                
-                # # If we found a pattern and haven't counted it yet
-                # if feature_key and feature_key not in counted_features:
-                #     counted_features.add(feature_key)
-                #     if verbose:
-                #         print(f'{r}, {c}: {direction_names[(dr, dc)]}, pattern: {pattern}')
-                #     count += 1
         
         return count
     
     @staticmethod
-    def get_connected_3_feature(board, player_pieces, not_occupied=.75, verbose=False):
+    def get_connected_3_feature(board, player_pieces, not_occupied=-1, verbose=False):
         '''Calculate the number of connected 3-in-a-row features
         
         Consider these two patterns:
@@ -590,7 +825,7 @@ class heuristic_agent(basic_agent):
         Inputs:
             board: numpy array
             player_pieces: numpy array, the coordinates of the player's pieces
-            not_occupied: value representing empty spaces (default: .75)
+            not_occupied: value representing empty spaces (default: -1)
             verbose: bool, whether to print debug information
             
         Outputs:
@@ -601,77 +836,46 @@ class heuristic_agent(basic_agent):
         
         rows, cols = board.shape
         count = 0
+        direction_names = ['horizontal', 'vertical', 'diagonal1', 'diagonal2']
         
-        # Directions to check: horizontal, vertical, diagonal1, diagonal2
-        directions = [(0, 1), (1, 0), (1, 1), (1, -1)]
-        direction_names = {(0, 1): 'horizontal', 
-                           (1, 0): 'vertical', 
-                           (1, 1): 'diagonal1', 
-                           (1,-1): 'diagonal2'}
-        
-        # Create a set of player piece coordinates for faster lookup
-        piece_set = set(map(tuple, player_pieces))
+        # the flattened board and the precomputed neighbors
+        # of each cell in the four directions
+        flat = board.ravel().tolist()
+        neighbors = four_in_a_row.neighbors
         player_color = int(board[player_pieces[0][0], player_pieces[0][1]])
         opponent_color = 1-player_color
         
-        # To avoid double counting
-        counted_features = set()
-        
         # return 1 if a connected 3-in-a-row is found 
         # for each location (r,c) with orientation (dr, dc)
-        # and 0 otherwise 
+        # and 0 otherwise. -1 marks a cell off the board
         for r, c in player_pieces:
-            for dr, dc in directions:
-                # Get coordinates for checking patterns
-                next_r, next_c = r + dr, c + dc
-                next2_r, next2_c = next_r + dr, next_c + dc
-                next3_r, next3_c = next2_r + dr, next2_c + dc
-                prev_r, prev_c = r - dr, c - dc
-                
+            for d, (prev2, prev, nxt, nxt2, nxt3) in enumerate(neighbors[r*cols+c]):
                 # Check if we have three connected pieces
-                if not ((next_r, next_c) in piece_set and 
-                       (next2_r, next2_c) in piece_set):
+                if not (nxt >= 0 and nxt2 >= 0 and
+                        flat[nxt] == player_color and 
+                        flat[nxt2] == player_color):
                     continue
-                    
-                # Check if coordinates are within bounds
-                next3_valid = 0 <= next3_r < rows and 0 <= next3_c < cols
-                prev_valid = 0 <= prev_r < rows and 0 <= prev_c < cols
-                
-                # Create feature key for deduplication
-                feature_key = None
-                pattern = None
                 
                 # Check xxx- pattern
-                if (next3_valid and 
-                    board[next3_r, next3_c] != opponent_color and
-                    (not prev_valid or board[prev_r, prev_c] != player_color)):
-                    feature_key = (r, c, dr, dc)
-                    pattern = "xxx-"
+                if (nxt3 >= 0 and 
+                    flat[nxt3] != opponent_color and
+                    (prev < 0 or flat[prev] != player_color)):
                     if verbose:
-                        print(f'{r}, {c}: {direction_names[(dr, dc)]}, pattern: {pattern}')
+                        print(f'{r}, {c}: {direction_names[d]}, pattern: xxx-')
                     count += 1
                 
                 # Check -xxx pattern
-                if (prev_valid and 
-                      board[prev_r, prev_c] != opponent_color and
-                      (not next3_valid or board[next3_r, next3_c] != player_color)):
-                    feature_key = (r, c, dr, dc)
-                    pattern = "-xxx"
+                if (prev >= 0 and 
+                      flat[prev] != opponent_color and
+                      (nxt3 < 0 or flat[nxt3] != player_color)):
                     if verbose:
-                        print(f'{r}, {c}: {direction_names[(dr, dc)]}, pattern: {pattern}')
+                        print(f'{r}, {c}: {direction_names[d]}, pattern: -xxx')
                     count += 1
-                
-                # # If we found a pattern and haven't counted it yet
-                # if feature_key and feature_key not in counted_features:
-                #     counted_features.add(feature_key)
-                #     if verbose:
-                #         print(f'{r}, {c}: {direction_names[(dr, dc)]}, pattern: {pattern}')
-                #     count += 1
         
         return count
 
     @staticmethod
-    def get_connected_4_feature(board, player_pieces, not_occupied=.75, verbose=False):
+    def get_connected_4_feature(board, player_pieces, not_occupied=-1, verbose=False):
         '''Calculate the number of connected 4-in-a-row features
         
         Look for pattern xxxx: four connected pieces in a row.
@@ -680,7 +884,7 @@ class heuristic_agent(basic_agent):
         Inputs:
             board: numpy array
             player_pieces: numpy array, the coordinates of the player's pieces
-            not_occupied: value representing empty spaces (default: .75)
+            not_occupied: value representing empty spaces (default: -1)
             verbose: bool, whether to print debug information
             
         Outputs:
@@ -691,53 +895,30 @@ class heuristic_agent(basic_agent):
         
         rows, cols = board.shape
         count = 0
+        direction_names = ['horizontal', 'vertical', 'diagonal1', 'diagonal2']
         
-        # Directions to check: horizontal, vertical, diagonal1, diagonal2
-        directions = [(0, 1), (1, 0), (1, 1), (1, -1)]
-        direction_names = {(0, 1): 'horizontal', 
-                           (1, 0): 'vertical', 
-                           (1, 1): 'diagonal1', 
-                           (1,-1): 'diagonal2'}
-        
-        # Create a set of player piece coordinates for faster lookup
-        piece_set = set(map(tuple, player_pieces))
+        # the flattened board and the precomputed neighbors
+        # of each cell in the four directions
+        flat = board.ravel().tolist()
+        neighbors = four_in_a_row.neighbors
         player_color = int(board[player_pieces[0][0], player_pieces[0][1]])
         
-        # To avoid double counting
-        counted_features = set()
-        
         # return 1 if a connected 4-in-a-row is found 
         # for each location (r,c) with orientation (dr, dc)
-        # and 0 otherwise 
+        # and 0 otherwise. -1 marks a cell off the board
         for r, c in player_pieces:
-            for dr, dc in directions:
-                # Get coordinates for checking patterns
-                next_r, next_c = r + dr, c + dc
-                next2_r, next2_c = next_r + dr, next_c + dc
-                next3_r, next3_c = next2_r + dr, next2_c + dc
-                prev_r, prev_c = r - dr, c - dc
-                
+            for d, (prev2, prev, nxt, nxt2, nxt3) in enumerate(neighbors[r*cols+c]):
                 # Check if we have four connected pieces
-                if not ((next_r, next_c) in piece_set and 
-                       (next2_r, next2_c) in piece_set and 
-                       (next3_r, next3_c) in piece_set):
+                if not (nxt3 >= 0 and
+                        flat[nxt] == player_color and 
+                        flat[nxt2] == player_color and 
+                        flat[nxt3] == player_color):
                     continue
-                    
-                # Check if coordinates are within bounds
-                prev_valid = 0 <= prev_r < rows and 0 <= prev_c < cols
                 
-                # Create feature key for deduplication
-                feature_key = None
-                
-                # Check xxxx pattern
-                if not prev_valid or board[prev_r, prev_c] != player_color:
-                    feature_key = (r, c, dr, dc)
-                
-                # If we found a pattern and haven't counted it yet
-                if feature_key and feature_key not in counted_features:
-                    counted_features.add(feature_key)
+                # Check xxxx pattern, counted once from its first piece
+                if prev < 0 or flat[prev] != player_color:
                     if verbose:
-                        print(f'{r}, {c}: {direction_names[(dr, dc)]}, pattern: xxxx')
+                        print(f'{r}, {c}: {direction_names[d]}, pattern: xxxx')
                     count += 1
         
         return count
@@ -745,53 +926,39 @@ class heuristic_agent(basic_agent):
 class accelerated_heuristic_agent(heuristic_agent):
     '''Accelerated heuristic agent
     
-    The accelerated heuristic agent which save
-    the results of the heuristic function
-    for the previous board in dictionaries, each
-    for one features. When the board is not encountered
-    before, the heuristic function is computed and
-    the result is saved in the dictionary. Otherwise,
-    the saved result is used.
-    
+    The heuristic agent with a persistent feature cache: the
+    raw features of the positions it evaluates are kept in
+    memory (LRU) and in a sqlite database on disk (see
+    data_fn.feature_db), shared by the runs and the worker 
+    processes. When a board is not found in either tier, its
+    features are computed and saved in both. The features 
+    hold the counts of both players, so the weights, and the 
+    player to move, are applied after the lookup. The 
+    database is data/cache/features.db unless db_fname is 
+    given. The new features are written in batches of 
+    flush_size rows, when the agent is pickled, and on 
+    flush(), e.g. at the end of a fit.
     '''
-    def __init__(self, env):
-        super().__init__(env)
-        self.prev_state = None
-        self.prev_value = None
+    def __init__(self, env, params, endgame=None, cache_size=2**17, 
+                 db_fname=None, seed=None):
+        super().__init__(env, params, endgame=endgame, cache_size=0, seed=seed)
+        store = feature_db() if db_fname is None else feature_db(db_fname)
+        self.cache = feature_cache(max(cache_size, 1), store=store)
+
+    def flush(self):
+        '''Write the new features to the database, so the 
+        other processes see them'''
+        self.cache.store.flush()
 
     def board2key(self, board):
-        '''Convert the board to a kay
+        '''Convert the board to a key, the Zobrist hash of
+        the pieces of both players
         '''
-        s = [' '.join(['.' if x==0.75 else '0' if x==0 else '1' for x in row]) for row in board]
-        return '-'.join(s)
+        return four_in_a_row.zobrist_hash((self.env.encode(board), four_in_a_row.player1_color))
     
     def heuristic(self, state: tuple, verbose=False):
-        '''Heuristic evaluation
-
-        The heuristic evaluation function for the van plan agent.
-
-        The evaluation considers five features:
-            1) value_center: whose pieces are closer to the center
-            2) value_c2: connected 2-in-a-row features:  - x x -
-            3) value_u2: unconnected 2-in-a-row features: x - x -
-            4) value_c3: connected 3-in-a-row features: - x x x -
-            5) value_c4: connected 4-in-a-row features: x x x x
-
-        The heuristic value is the weighted sum of these features:
-
-            value = w_center * value_center 
-                        
-                        + w_c2 * value_c2(self.player_id) 
-                        + w_u2 * value_u2(self.player_id) 
-                        + w_c3 * value_c3(self.player_id) 
-                        + w_c4 * value_c4(self.player_id)
-
-                        - w_c2 * value_c2(self.opponent_id) 
-                        - w_u2 * value_u2(self.opponent_id) 
-                        - w_c3 * value_c2(self.opponent_id) 
-                        - w_c4 * value_c2(self.opponent_id)
-
-                        + N(0, 1)
+        '''Heuristic evaluation, the same value as 
+        heuristic_agent.heuristic, from the cached features
 
         Inputs:
             state: tuple (board, player_id)
@@ -799,135 +966,14 @@ class accelerated_heuristic_agent(heuristic_agent):
         Outputs:
             value: float
         '''
-        # get the board and player id 
         board, id_to_move = state
-        player_pieces = np.vstack(np.where(board==self.player_id)).T
-        C_player = 1 if id_to_move==self.player_id else self.C
-        # the opponent id 
-        opponent_id = int(1-self.player_id)
-        opponent_pieces = np.vstack(np.where(board==opponent_id)).T
-        C_opponent = 1 if id_to_move==self.opponent_id else self.C
-        
-        # get the center value
-        value_center = self.get_center_value(self.env.center, 
-                                             player_pieces, 
-                                             opponent_pieces)
-        
-        # get the connected 2-in-a-row value
-        feature_c2 = 0
-        if 'connected_2_feature' in self.features:
-            if verbose: print('\n connected 2-in-a-row:')
-            if verbose: print('player:')
-            f_c2_player = self.get_cached_connected_2_feature(board, player_pieces, verbose=verbose)
-            if verbose: print('opponent:')
-            f_c2_opponent = self.get_cached_connected_2_feature(board, opponent_pieces, verbose=verbose)
-            feature_c2 = C_player*f_c2_player - C_opponent*f_c2_opponent
-        
-        # get the unconnected 2-in-a-row value
-        feature_u2 = 0
-        if 'unconnected_2_feature' in self.features:
-            if verbose: print('\n unconnected 2-in-a-row:')
-            if verbose: print('player:')
-            f_u2_player = self.get_cached_unconnected_2_feature(board, player_pieces, verbose=verbose)
-            if verbose: print('opponent:')
-            f_u2_opponent = self.get_cached_unconnected_2_feature(board, opponent_pieces, verbose=verbose)
-            feature_u2 = C_player*f_u2_player - C_opponent*f_u2_opponent
-        
-        # get the connected 3-in-a-row value
-        feature_c3 = 0
-        if 'connected_3_feature' in self.features:
-            if verbose: print('\n connected 3-in-a-row:')
-            if verbose: print('player:')
-            f_c3_player = self.get_cached_connected_3_feature(board, player_pieces, verbose=verbose)
-            if verbose: print('opponent:')
-            f_c3_opponent = self.get_cached_connected_3_feature(board, opponent_pieces, verbose=verbose)
-            feature_c3 = C_player*f_c3_player - C_opponent*f_c3_opponent
-            
-        # get the connected 4-in-a-row value
-        feature_c4 = 0
-        if 'connected_4_feature' in self.features:
-            if verbose: print('\n connected 4-in-a-row:')
-            if verbose: print('player:')
-            f_c4_player = self.get_cached_connected_4_feature(board, player_pieces, verbose=verbose)
-            if verbose: print('opponent:')
-            f_c4_opponent = self.get_cached_connected_4_feature(board, opponent_pieces, verbose=verbose)
-            feature_c4 = C_player*f_c4_player - C_opponent*f_c4_opponent
-
-        # combine the value   
-        noise = np.random.randn() 
-        value = self.w_ce * value_center \
-                    + self.w_c2 * feature_c2 \
-                    + self.w_u2 * feature_u2 \
-                    + self.w_c3 * feature_c3 \
-                    + self.w_c4 * feature_c4 \
-                    + noise
-        
+        board = self.env.encode(board)
+        features = self.cache.get_many([self.board2key(board)], 
+                                       lambda _: get_features(board[None]))
+        value = self.heuristic_many(None, id_to_move, features)[0]
+        if verbose: print(f'features: {features[0].tolist()}, value: {value:.3f}')
         return value
 
-    def get_cached_connected_2_feature(self, board, player_pieces, not_occupied=.75, verbose=False):
-        '''Get the cached value of the board
-        '''
-        # get the cached file
-        cached_file = f'{pth}/accelerated_heuristic/cached_connected_2_feature.pkl'
-        with open(cached_file, 'rb') as f:cached_features = pickle.load(f)
-        # check if the board is cached
-        key = self.board2key(board)
-        if key in cached_features:
-            return cached_features[key]
-        else:
-            c2_features = self.get_connected_2_feature(board, player_pieces, not_occupied, verbose)
-            cached_features[key] = c2_features
-            with open(cached_file, 'wb') as f: pickle.dump(cached_features, f)
-            return c2_features
-    
-    def get_cached_unconnected_2_feature(self, board, player_pieces, not_occupied=.75, verbose=False):
-        '''Get the cached value of the board
-        '''
-        # get the cached file
-        cached_file = f'{pth}/accelerated_heuristic/cached_unconnected_2_feature.pkl'
-        with open(cached_file, 'rb') as f:cached_features = pickle.load(f)
-        # check if the board is cached
-        key = self.board2key(board)
-        if key in cached_features:
-            return cached_features[key]
-        else:
-            u2_features = self.get_unconnected_2_feature(board, player_pieces, not_occupied, verbose)
-            cached_features[key] = u2_features
-            with open(cached_file, 'wb') as f: pickle.dump(cached_features, f)
-            return u2_features
-        
-    def get_cached_connected_3_feature(self, board, player_pieces, not_occupied=.75, verbose=False):
-        '''Get the cached value of the board
-        '''
-        # get the cached file
-        cached_file = f'{pth}/accelerated_heuristic/cached_connected_3_feature.pkl'
-        with open(cached_file, 'rb') as f:cached_features = pickle.load(f)
-        # check if the board is cached
-        key = self.board2key(board)
-        if key in cached_features:
-            return cached_features[key]
-        else:
-            c3_features = self.get_connected_3_feature(board, player_pieces, not_occupied, verbose)
-            cached_features[key] = c3_features
-            with open(cached_file, 'wb') as f: pickle.dump(cached_features, f)
-            return c3_features
-    
-    def get_cached_connected_4_feature(self, board, player_pieces, not_occupied=.75, verbose=False):
-        '''Get the cached value of the board
-        '''
-        # get the cached file
-        cached_file = f'{pth}/accelerated_heuristic/cached_connected_4_feature.pkl'
-        with open(cached_file, 'rb') as f:cached_features = pickle.load(f)
-         # check if the board is cached
-        key = self.board2key(board)
-        if key in cached_features:
-            return cached_features[key]
-        else:
-            c4_features = self.get_connected_4_feature(board, player_pieces, not_occupied, verbose)
-            cached_features[key] = c4_features
-            with open(cached_file, 'wb') as f: pickle.dump(cached_features, f)
-            return c4_features
-
 # ------------ Basic plan agents ------------ #
 
 class BFS_agent(heuristic_agent):
@@ -936,7 +982,15 @@ class BFS_agent(heuristic_agent):
 
     @staticmethod
     def show_node(node, not_occupied=0.75):
-        board, player_id = node.state
+        if node.state is None:
+            # replay the path from the root
+            root, path = node.path()
+            position = search_position(root.state)
+            for action in path: position.push(action)
+            board, player_id = position.state
+        else:
+            board, player_id = node.state
+        board = four_in_a_row.decode(board)
         player_color = 'black' if player_id==0 else 'white'
         value = node.value
         rows, cols = board.shape
@@ -961,30 +1015,35 @@ class BFS_agent(heuristic_agent):
         # This will block until the window is closed
         plt.show(block=True)
 
-    def get_action(self, state):
-        root = self.plan(state)
+    def get_action(self, state, features=None):
+        root = self.plan(state, features)
         action = self.minmax(root).action
         return (int(action[0]), int(action[1]))
     
-    def plan(self, state):
+    def plan(self, state, features=None):
+        state = (self.env.encode(state[0]), state[1])
         # assign player id
         self.player_id  = state[1]
         self.opponent_id = 1-self.player_id
         # drop a feature
         self.drop_feature(self.delta)
+        # the search position, the tree is expanded on it
+        self.position = self.env.position(state)
         # construct the root node 
+        if features is None: features = self.root_features()
         root = Node(
             state=deepcopy(state),
             action=None, 
             parent=None, 
-            heuristic_fn=self.heuristic,
-            depth=0
+            value=self.heuristic_many(None, state[1], features[None])[0],
+            depth=0,
+            features=features
         )
         # randomly pick an action if lapse
         if self.lapse(self.lmbda):
             # get the valid actions
             valid_actions = self.env.get_valid_actions(state[0])
-            idx = np.random.choice(len(valid_actions))
+            idx = self.rng.integers(len(valid_actions))
             child_node = Node(
                 state=deepcopy(state),
                 action=valid_actions[idx],
@@ -1029,7 +1088,7 @@ class BFS_agent(heuristic_agent):
     # ------------ aux functions ------------- #
     
     def lapse(self, lmbda):
-        return np.random.rand() < lmbda
+        return self.rng.uniform() < lmbda
     
     def drop_feature(self, delta):
         '''Drop a feature from the heuristic evaluation
@@ -1040,18 +1099,19 @@ class BFS_agent(heuristic_agent):
         - connected 3-in-a-row
         - connected 4-in-a-row
         
+        The features kept are a bitmask (self.subset), which
+        selects their weights in heuristic_many, so the cached
+        raw features serve every subset.
+
         Inputs:
             delta: float, the probability of dropping a feature
             
         '''
-        features = ['connected_2_feature', 
-                    'unconnected_2_feature', 
-                    'connected_3_feature', 
-                    'connected_4_feature']
-        self.features = [f for f in features if np.random.rand() > delta]
+        kept = self.rng.uniform(len(feature_names)) > delta
+        self.subset = int(kept@(1 << np.arange(len(feature_names))))
 
     def stop(self, gamma):
-        return np.random.rand() < gamma
+        return self.rng.uniform() < gamma
     
     def determine(self, root):
         root_action = self.minmax(root).action
@@ -1086,7 +1146,7 @@ class BFS_agent(heuristic_agent):
         # if the node is a leaf node, return the node
         if len(node.children) == 0: return node
         # if it is the player's turn, choose the child with the highest value
-        if self.player_id==node.state[1]:
+        if self.player_id==node.player:
             best_node, best_value = None, -np.inf
             for child in node.children:
                 if child.value > best_value:
@@ -1100,31 +1160,6 @@ class BFS_agent(heuristic_agent):
                     best_node, best_value = child, child.value
             return best_node
         
-    def expand_node(self, node: Node):
-        '''Expand the node through breadth first search'''
-        state = node.state
-        valid_actions = self.env.get_valid_actions(state[0])
-        if len(valid_actions)>0:
-            # expand the node throught breadth first search
-            for action in valid_actions:
-                # this deepcopy is important
-                # as the transit function will modify the state
-                # we need to keep the original state for the parent node
-                # otherwise, the state will be modified
-                state_next, _, done, info = self.env.transit(deepcopy(state), action)
-                child_node = Node(
-                    state=state_next, 
-                    action=action, 
-                    parent=node, 
-                    heuristic_fn=self.heuristic,
-                    depth=node.depth+1
-                )
-                node.children.append(child_node)
-            # get the max value of the children
-            max_value = self.minmax(node).value
-            # prune the low value children
-            node.children = [child for child in node.children if np.abs(child.value-max_value)<=self.theta]
-
     def backpropagate(self, node):
         '''Backpropagate the value of the node
         if the selected child is a termination node,
@@ -0,0 +1,202 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from utils.env_fn import four_in_a_row
+from utils.data_fn import state_store, load_design_response, game_log, position_index, endgame_table, \
+    feature_table, use_dataset
+from utils.feature_fn import get_features
+from utils.model import heuristic_agent, BFS_agent, default_params
+from utils.env_fn import search_position
+from utils.test_env import random_games
+
+
+def test_state_store(tmp_path):
+    """The store reproduces the idx2state pickle"""
+    states = [state for state, _ in random_games(10, seed=0)]
+    idx2state = {i: np.append(four_in_a_row.decode(board).ravel(), player)
+                 for i, (board, player) in enumerate(states)}
+    src_fname, fname = f'{tmp_path}/idx2state.pkl', f'{tmp_path}/idx2state.npy'
+    with open(src_fname, 'wb') as f: pickle.dump(idx2state, f)
+
+    store = state_store.load(fname, src_fname)
+    assert os.path.exists(fname) and len(store)==len(states)
+    assert state_store.load(fname, src_fname) is store
+    assert pickle.loads(pickle.dumps(store)) is store
+
+    idx = np.random.default_rng(0).permutation(len(states))
+    boards, players = store.embed_many(idx)
+    assert boards.dtype==np.int8
+    for i, board, player in zip(idx, boards, players):
+        assert np.array_equal(board, states[i][0]) and player==states[i][1]
+        board, player = store.embed(i)
+        assert np.array_equal(board, states[i][0]) and player==states[i][1]
+    # slices are views of the mapping
+    boards, _ = store.embed_many(slice(2, 5))
+    assert np.shares_memory(boards, store.data) and not boards.flags.writeable
+
+def test_design_response_mat(tmp_path):
+    """Bulk parsing matches eval per trial, and the cache follows the file"""
+    rng = np.random.default_rng(0)
+    actions = [str((int(x), int(y))) for x, y in zip(rng.integers(4, size=60), rng.integers(9, size=60))]
+    actions[:3] = ['(np.int64(1), np.int64(4))', '(0, 8)', '(3,0)']
+    sub_data = {block: pd.DataFrame({'state_idx': rng.integers(1000, size=20),
+                                     'action': actions[block*20:(block+1)*20]})
+                for block in range(3)}
+    design, response = four_in_a_row.get_design_response_mat(sub_data)
+    design_loop = [s for block in sub_data.values() for s in block['state_idx']]
+    response_loop = [four_in_a_row.action2idx(eval(a, {'np': np})) for a in actions]
+    assert np.array_equal(design, design_loop)
+    assert np.array_equal(response, response_loop)
+
+    fname, cache_pth = f'{tmp_path}/sub.csv', f'{tmp_path}/cache'
+    pd.concat(sub_data.values()).to_csv(fname, index=False)
+    for _ in range(2):
+        design_csv, response_csv = load_design_response(fname, cache_pth)
+        assert np.array_equal(design_csv, design) and np.array_equal(response_csv, response)
+    assert len(os.listdir(cache_pth))==1
+    # a changed file invalidates the cache
+    pd.concat(sub_data.values())[:10].to_csv(fname, index=False)
+    os.utime(fname, (0, os.path.getmtime(fname)+1))
+    design_csv, _ = load_design_response(fname, cache_pth)
+    assert np.array_equal(design_csv, design[:10])
+
+def test_game_log(tmp_path):
+    """The log replays the games it was given"""
+    samples = random_games(20, seed=3)
+    games, actions = [], []
+    for state, action in samples:
+        if action is None: games.append(actions); actions = []
+        else: actions.append(action)
+    fname = f'{tmp_path}/games.fiar'
+    log = game_log(fname)
+    for actions in games: log.append(actions)
+    assert os.path.getsize(fname)==7+len(samples)
+    assert [list(map(four_in_a_row.idx2action, m)) for m in log]==games
+    positions = list(log.positions())
+    assert len(positions)==len(samples)-len(games)
+    for (state, action), (ref_state, ref_action) in zip(positions, [p for p in samples if p[1] is not None]):
+        assert np.array_equal(state[0], ref_state[0]) and state[1]==ref_state[1] and action==ref_action
+    *_, (_, _, done, _) = game_log.replay(next(iter(log)))
+    assert done
+    # a crash mid-write leaves a tail that is skipped
+    with open(fname, 'ab') as f: f.write(bytes([5, 1, 2]))
+    assert len(list(game_log(fname)))==len(games)
+    # the csv files of play.py, with a click on an occupied cell
+    csv_fnames = []
+    for i, actions in enumerate(games[:3]):
+        csv_fnames.append(f'{tmp_path}/game-{i}.csv')
+        clicks = actions[:2]+actions[1:2]+actions[2:]
+        pd.DataFrame({'action': [str(a) for a in clicks]}).to_csv(csv_fnames[-1], index=False)
+    log = game_log.from_csv(csv_fnames, f'{tmp_path}/converted.fiar')
+    assert [list(map(four_in_a_row.idx2action, m)) for m in log]==games[:3]
+
+def test_position_index(tmp_path):
+    """Indexing a log in two steps gives the index of one step"""
+    games = []
+    log = game_log(f'{tmp_path}/games.fiar')
+    samples, actions = random_games(30, seed=5), []
+    for state, action in samples:
+        if action is None: log.append(actions); games.append(actions); actions = []
+        else: actions.append(action)
+    # a repeated game only adds counts
+    log.append(games[0])
+
+    index = position_index(f'{tmp_path}/full')
+    design, response = index.add_log(log.fname)
+    assert index.add_log(log.fname)[0].size==0
+    assert len(design)==len(samples)-len(games)+len(games[0])
+    assert index.counts.sum()==len(design) and len(index)==len(np.unique(design))
+    store = index.store()
+    for (state, action), state_idx, action_idx in zip(
+            [p for p in samples if p[1] is not None], design, response):
+        assert np.array_equal(store.boards[state_idx], state[0])
+        assert store.players[state_idx]==state[1]
+        assert index.lookup(state)==state_idx
+        assert four_in_a_row.idx2action(action_idx)==action
+
+    # the same index, built incrementally and reopened
+    fname = f'{tmp_path}/growing.fiar'
+    growing = game_log(fname)
+    for actions in games[:10]: growing.append(actions)
+    position_index(f'{tmp_path}/part').add_log(fname)
+    size = len(position_index(f'{tmp_path}/part').store())
+    for actions in games[10:]+games[:1]: growing.append(actions)
+    part = position_index(f'{tmp_path}/part')
+    design_new, _ = part.add_log(fname)
+    assert len(design_new)==len(design)-sum(len(a) for a in games[:10])
+    assert len(part.store())>size
+    assert np.array_equal(part.store().data, store.data)
+    assert np.array_equal(part.counts, index.counts)
+
+def test_endgame_table(tmp_path):
+    """The table returns the solved values and nothing else"""
+    states = [s for s, a in random_games(40, seed=9) if a is not None]
+    fname = f'{tmp_path}/endgame.npy'
+    endgame_table.build(states, fname, max_empty=5)
+    table = endgame_table.load(fname)
+    assert pickle.loads(pickle.dumps(table)) is table
+    n_late = 0
+    for state in states:
+        value = table.lookup(four_in_a_row.canonical_hash(state))
+        if (state[0]==four_in_a_row.not_occupied).sum()<=5:
+            n_late += 1
+            assert value==search_position(state).solve()
+        elif (state[0]==four_in_a_row.not_occupied).sum()>6:
+            assert value is None
+    assert n_late>0 and len(table)>=n_late
+
+def test_feature_table(tmp_path):
+    """The table follows the store as it grows, and the agents
+    act the same with the features read from it"""
+    samples, games, actions = random_games(20, seed=7), [], []
+    for state, action in samples:
+        if action is None: games.append(actions); actions = []
+        else: actions.append(action)
+    fname = f'{tmp_path}/games.fiar'
+    log, index = game_log(fname), position_index(f'{tmp_path}/index')
+    for actions in games[:10]: log.append(actions)
+    index.add_log(fname)
+    size = len(index.features())
+    for actions in games[10:]: log.append(actions)
+    index.add_log(fname)
+    table = index.features()
+    assert len(table)==len(index.store())>size
+    assert pickle.loads(pickle.dumps(table)) is table
+    assert np.allclose(table[:], get_features(index.store().boards))
+
+    env, params = four_in_a_row(), default_params().to_list()
+    idx = np.arange(0, len(table), 7)
+    for agent_fn in [heuristic_agent, BFS_agent]:
+        agent = agent_fn(env, params, cache_size=0)
+        for state_idx in idx:
+            agent.seed(state_idx)
+            action = agent.get_action(index.store().embed(state_idx))
+            agent.seed(state_idx)
+            assert agent.get_action(index.store().embed(state_idx), table[state_idx])==action
+
+    # the index as the dataset of a fit
+    index = position_index(f'{tmp_path}/index')
+    index.use()
+    try:
+        boards, players = four_in_a_row.embed_many(idx)
+        assert np.array_equal(boards, index.store().boards[idx])
+        assert np.array_equal(four_in_a_row.embed_features(idx), table[idx])
+        agent = heuristic_agent(env, params)
+        assert len(agent.response_generator(params, idx))==len(idx)
+        # reading the dataset does not load the hashes
+        assert index._hash2idx is None and len(index)==len(table)
+    finally:
+        use_dataset()
+
+
+if __name__ == "__main__":
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_path:
+        test_state_store(tmp_path)
+        test_design_response_mat(tmp_path)
+        test_game_log(tmp_path)
+        test_position_index(tmp_path)
+        test_endgame_table(tmp_path)
+        test_feature_table(tmp_path)
+    print("All tests passed!")
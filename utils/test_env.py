@@ -0,0 +1,238 @@
+import numpy as np
+from utils.env_fn import four_in_a_row, bitboard_four_in_a_row, search_position
+
+
+def random_games(n_games=200, seed=0):
+    """Play random games with the reference engine and
+    collect every (state, action) pair along the way"""
+    rng = np.random.default_rng(seed)
+    env = four_in_a_row()
+    samples = []
+    for _ in range(n_games):
+        state, done = env.reset(), False
+        while not done:
+            actions = env.get_valid_actions(state[0])
+            action = actions[rng.integers(len(actions))]
+            samples.append((state, action))
+            state, _, done, _ = env.transit(state, action)
+        samples.append((state, None))
+    return samples
+
+def test_transit_detects_end_of_game():
+    env = four_in_a_row()
+    board = four_in_a_row.layout2board([
+        '000......',
+        '111......',
+        '.........',
+        '.........',
+    ])
+    _, reward, done, info = env.transit((board, 0), (0, 3))
+    assert done and reward==1 and info['winner']=='black'
+    _, reward, done, info = env.transit((board, 0), (0, 4))
+    assert not done and reward==0 and info=={}
+
+def test_int8_board_conversion():
+    layout = ['1.001...1', '...10....', '..0.0....', '11..00...']
+    board = four_in_a_row.layout2board(layout)
+    encoded = four_in_a_row.encode(board)
+    assert encoded.dtype==np.int8 and encoded.nbytes==36
+    assert (encoded==four_in_a_row.not_occupied).sum()==(board==.75).sum()
+    assert np.array_equal(four_in_a_row.decode(encoded), board)
+    assert four_in_a_row.board2layout(encoded)==layout
+    assert four_in_a_row.encode(encoded) is encoded
+
+def test_bitboard_engine_equivalence():
+    """The bitboard engine reproduces the reference engine"""
+    ref, fast = four_in_a_row(), bitboard_four_in_a_row()
+    for state, action in random_games():
+        board, player = state
+        assert ref.get_valid_actions(board)==fast.get_valid_actions(board)
+        assert ref.check_win(board)==fast.check_win(board)
+        assert ref.check_draw(board)==fast.check_draw(board)
+        assert np.array_equal(fast.bits2board(*fast.board2bits(board)), board)
+        if action is None: continue
+        ref_next, ref_r, ref_done, ref_info = ref.transit(state, action)
+        fast_next, fast_r, fast_done, fast_info = fast.transit(state, action)
+        assert np.array_equal(ref_next[0], fast_next[0])
+        assert ref_next[1]==fast_next[1]
+        assert (ref_r, ref_done, ref_info)==(fast_r, fast_done, fast_info)
+        # the transition on the masks only
+        bits_next, *outputs = fast.transit_bits(fast.board2bits(board), player, four_in_a_row.action2idx(action))
+        assert bits_next==fast.board2bits(fast_next[0])
+        assert outputs==[fast_r, fast_done, fast_info]
+
+def test_bitboard_step():
+    """The engine steps on (board, curr_player) states, as the 
+    reference engine, and keeps the masks of its state"""
+    ref, fast, rng = four_in_a_row(), bitboard_four_in_a_row(), np.random.default_rng(3)
+    for _ in range(20):
+        ref_state, state, done = ref.reset(), fast.reset(), False
+        while not done:
+            # an occupied cell leaves the state as it is
+            occupied = np.argwhere(state[0]!=four_in_a_row.not_occupied)
+            if len(occupied): 
+                assert fast.step(tuple(occupied[0]))[0] is state
+            actions = fast.get_valid_actions(state[0])
+            action = actions[rng.integers(len(actions))]
+            ref_state, *ref_outputs = ref.step(action)
+            (board, player), *outputs = fast.step(action)
+            assert np.array_equal(board, ref_state[0]) and player==ref_state[1]
+            assert outputs==ref_outputs and fast.hash==ref.hash
+            assert fast.bits==fast.board2bits(board)
+            state, done = fast.state, outputs[1]
+
+def test_transit_batch_matches_transit():
+    """The batched transition reproduces transit game by game"""
+    env = four_in_a_row()
+    samples = [(s, a) for s, a in random_games(100, seed=1) if a is not None]
+    # also try occupied cells, which leave the game unchanged
+    rng = np.random.default_rng(1)
+    samples += [(s, (int(r), int(c))) for (s, _), r, c in 
+                zip(samples[:500], rng.integers(4, size=500), rng.integers(9, size=500))]
+    boards = np.stack([s[0] for s, _ in samples])
+    players = np.array([s[1] for s, _ in samples])
+    actions = np.array([a for _, a in samples])
+    (boards_next, players_next), rewards, dones, winners = \
+        env.transit_batch(boards, players, actions)
+    for i, (state, action) in enumerate(samples):
+        next_state, reward, done, info = env.transit(state, action)
+        assert np.array_equal(next_state[0], boards_next[i])
+        assert next_state[1]==players_next[i]
+        assert reward==rewards[i] and done==dones[i]
+        winner = {'black': 0, 'white': 1}.get(info.get('winner'), -1)
+        assert winner==winners[i]
+
+def test_search_position_push_pop():
+    """push follows transit and pop restores the position"""
+    env = four_in_a_row()
+    for state, action in random_games(50, seed=2):
+        position = search_position(state)
+        board = position.board.copy()
+        assert position.get_valid_actions()==env.get_valid_actions(state[0])
+        if action is None: 
+            assert position.done
+            continue
+        next_state, _, done, info = env.transit(state, action)
+        position.push(action)
+        assert np.array_equal(position.board, next_state[0])
+        assert position.curr_player==next_state[1] and position.done==done
+        winner = {'black': 0, 'white': 1}.get(info.get('winner'), -1)
+        assert position.winner==winner
+        position.pop()
+        assert np.array_equal(position.board, board)
+        assert position.curr_player==state[1] and not position.done
+        assert position.bits==list(bitboard_four_in_a_row.board2bits(board))
+
+def test_zobrist_hash_incremental():
+    """The hash followed by XOR matches the full hash"""
+    env, rng = four_in_a_row(), np.random.default_rng(4)
+    hashes = {}
+    for _ in range(30):
+        state, done = env.reset(), False
+        position = search_position(state)
+        while not done:
+            actions = env.get_valid_actions(state[0])
+            action = actions[rng.integers(len(actions))]
+            state, _, done, _ = env.step(action)
+            position.push(action)
+            h = four_in_a_row.zobrist_hash(state)
+            assert env.hash==position.hash==h
+            assert position.canonical_hash==four_in_a_row.canonical_hash(state)
+            # the same hash for the same position only
+            key = (state[0].tobytes(), state[1])
+            assert hashes.setdefault(h, key)==key
+        while position.stack: position.pop()
+        assert position.hash==0
+
+def test_symmetry_canonicalization():
+    """Reflections share the canonical board and hash"""
+    n_symmetries = four_in_a_row.n_symmetries
+    for state, action in random_games(20, seed=6):
+        if action is None: continue
+        board, player = state
+        canonical, transform = four_in_a_row.canonicalize(board)
+        hashes = four_in_a_row.symmetry_hashes(state)
+        for t in range(n_symmetries):
+            view = four_in_a_row.transform_board(board, t)
+            assert four_in_a_row.zobrist_hash((view, player))==hashes[t]
+            assert four_in_a_row.canonical_hash((view, player))==min(hashes)
+            assert np.array_equal(four_in_a_row.canonicalize(view)[0], canonical)
+            # actions follow the pieces through the transform
+            x, y = four_in_a_row.transform_action(action, t)
+            assert view[x, y]==board[action]
+            assert four_in_a_row.transform_action((x, y), t)==tuple(action)
+        x, y = four_in_a_row.transform_action(action, transform)
+        assert canonical[x, y]==board[action]
+
+def test_perft_engines_agree():
+    """The engines count the same game trees"""
+    env, fast = four_in_a_row(), bitboard_four_in_a_row()
+    # the empty board, and late positions where draws happen
+    states = [(env.reset(), 2)]
+    states += [(s, 4) for s, a in random_games(60, seed=7) if a is not None and
+               (s[0]==four_in_a_row.not_occupied).sum()<=5]
+    totals = np.zeros(3, dtype=int)
+    for state, depth in states:
+        counts = env.perft(state, depth)
+        assert fast.perft(state, depth)==counts
+        assert search_position(state).perft(depth)==counts
+        assert four_in_a_row.perft_batch(state, depth)==counts
+        totals += counts
+    assert env.perft(states[0][0], 2)==(36+36*35, 0, 0)
+    assert totals[1]>0 and totals[2]>0
+
+def test_endgame_solve():
+    """The memoized solver matches a plain negamax"""
+    env = four_in_a_row()
+    def negamax(state):
+        best = -1
+        for action in env.get_valid_actions(state[0]):
+            next_state, reward, done, info = env.transit(state, action)
+            value = reward if done else -negamax(next_state)
+            best = max(best, value)
+            if best==1: break
+        return best
+    table, values = {}, []
+    for state, action in random_games(200, seed=8):
+        if action is None or (state[0]==four_in_a_row.not_occupied).sum()>7: continue
+        value = search_position(state).solve(table)
+        assert value==negamax(state)
+        assert table[four_in_a_row.canonical_hash(state)]==value
+        values.append(value)
+    assert set(values)=={-1, 0, 1}
+
+def test_threats_match_check_win_action():
+    """The threat masks are the empty cells that win"""
+    env = four_in_a_row()
+    n_threats = 0
+    for state, action in random_games(100, seed=10):
+        board = state[0]
+        empty = [four_in_a_row.idx2action(i) for i in np.flatnonzero(board==four_in_a_row.not_occupied)]
+        threats = four_in_a_row.get_threats(board)
+        for player_id in [0, 1]:
+            ref = [a for a in empty if env.check_win_action(
+                    env.transit((board, player_id), a)[0][0], a, player_id)]
+            assert threats[player_id]==ref
+            n_threats += len(ref)
+        if action is None: continue
+        position = search_position(state)
+        position.push(action)
+        black, white = position.threats
+        next_threats = four_in_a_row.get_threats(position.board)
+        assert bitboard_four_in_a_row.bits2actions(black)==next_threats[0]
+        assert bitboard_four_in_a_row.bits2actions(white)==next_threats[1]
+    assert n_threats>0
+
+
+if __name__ == "__main__":
+    test_transit_detects_end_of_game()
+    test_int8_board_conversion()
+    test_bitboard_engine_equivalence()
+    test_transit_batch_matches_transit()
+    test_search_position_push_pop()
+    test_zobrist_hash_incremental()
+    test_symmetry_canonicalization()
+    test_perft_engines_agree()
+    test_endgame_solve()
+    test_threats_match_check_win_action()
+    print("All tests passed!")
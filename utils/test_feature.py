@@ -0,0 +1,144 @@
+import numpy as np
+from utils.env_fn import four_in_a_row
+from utils.model import heuristic_agent, BFS_agent, default_params
+from utils.feature_fn import get_feature_counts, get_feature_deltas, feature_names, \
+    count_patterns, get_digits, encode_windows, sum_patterns, off_board, \
+    get_features, feature_cache, get_center_value, n_subsets
+from utils.test_env import random_games
+
+
+def random_boards(n_boards=2000, seed=0):
+    """Boards of random games, and random fillings that
+    also have lines of both players and unbalanced counts"""
+    boards = [state[0] for state, _ in random_games(100, seed=seed)]
+    rng = np.random.default_rng(seed)
+    for _ in range(n_boards-len(boards)):
+        p_empty = rng.uniform(.1, .9)
+        boards.append(rng.choice([-1, 0, 1], size=[four_in_a_row.rows, four_in_a_row.cols],
+                                 p=[p_empty, (1-p_empty)/2, (1-p_empty)/2]).astype(np.int8))
+    return np.stack(boards)
+
+def loop_feature_counts(board):
+    """The counts of the heuristic_agent loops"""
+    counts = np.zeros([2, len(feature_names)], dtype=int)
+    for player_id in [0, 1]:
+        pieces = np.vstack(np.where(board==player_id)).T
+        for k, name in enumerate(feature_names):
+            counts[player_id, k] = getattr(heuristic_agent, f'get_{name}')(board, pieces)
+    return counts
+
+def test_feature_counts_match_loops():
+    """The vectorized counts equal the loops on every board"""
+    boards = random_boards()
+    counts = get_feature_counts(boards, batch_size=300)
+    assert counts.shape==(len(boards), 2, len(feature_names))
+    for board, board_counts in zip(boards, counts):
+        assert np.array_equal(board_counts, loop_feature_counts(board))
+        assert np.array_equal(get_feature_counts(four_in_a_row.decode(board)), board_counts)
+    # every feature occurs in the corpus
+    assert (counts.sum(axis=(0, 1))>0).all()
+
+def test_heuristic_many_matches_heuristic():
+    """The batched values equal heuristic board by board"""
+    agent = heuristic_agent(four_in_a_row(), default_params().to_list())
+    boards = random_boards(300, seed=1)
+    players = np.random.default_rng(1).integers(2, size=len(boards))
+    for player_id, features in [(0, agent.features), (1, agent.features[1:3])]:
+        agent.player_id, agent.opponent_id = player_id, 1-player_id
+        agent.features = features
+        agent.seed(0)
+        values = agent.heuristic_many(boards, players)
+        agent.seed(0)
+        ref = [agent.heuristic((board, player)) for board, player in zip(boards, players)]
+        assert np.allclose(values, ref)
+
+def test_feature_subsets():
+    """The raw features of a batch serve every subset of the
+    features, with the values of heuristic"""
+    agent = heuristic_agent(four_in_a_row(), default_params().to_list())
+    agent.player_id, agent.opponent_id = 1, 0
+    boards = random_boards(20, seed=3)
+    features = get_features(boards)
+    for subset in range(n_subsets):
+        agent.subset = subset
+        assert agent.features==[name for k, name in enumerate(feature_names) if subset>>k & 1]
+        agent.features = agent.features
+        assert agent.subset==subset
+        agent.seed(subset)
+        values = agent.heuristic_many(None, 0, features)
+        agent.seed(subset)
+        assert np.allclose(values, [agent.heuristic((board, 0)) for board in boards])
+
+def test_feature_deltas_match_recount():
+    """Parent counts plus deltas equal the counts of the children"""
+    for board in random_boards(300, seed=2):
+        cells = np.flatnonzero(board==four_in_a_row.not_occupied)
+        if len(cells)==0: continue
+        counts = get_feature_counts(board)
+        for player_id in [0, 1]:
+            children = np.repeat(board[None], len(cells), axis=0)
+            children.reshape([len(cells), -1])[np.arange(len(cells)), cells] = player_id
+            deltas = get_feature_deltas(board, cells, player_id)
+            assert np.array_equal(counts+deltas, get_feature_counts(children))
+
+def test_pattern_table_matches_patterns():
+    """The table lookup counts every window like the patterns"""
+    rng = np.random.default_rng(3)
+    windows = rng.choice([four_in_a_row.not_occupied, 0, 1, off_board], size=[500, 7, 6])
+    # each window is read as a board of its 6 cells
+    codes = encode_windows(get_digits(windows), np.arange(6))
+    assert np.array_equal(np.moveaxis(sum_patterns(codes), 0, 1), count_patterns(windows))
+
+def test_center_value_matches_norms():
+    """The dot products with the cell values equal the sums of
+    the inverse distances, board by board and in a batch"""
+    boards = random_boards(300, seed=2)
+    values = get_center_value(boards)
+    assert values.shape==(len(boards), 2)
+    for board, board_values in zip(boards, values):
+        pieces = [np.vstack(np.where(board==player_id)).T for player_id in [0, 1]]
+        dists = [1/np.linalg.norm(p-four_in_a_row.center, axis=1) for p in pieces]
+        assert np.allclose(board_values, [d.sum() for d in dists])
+        assert np.isclose(heuristic_agent.get_center_value(four_in_a_row.center, *pieces),
+                          dists[0].sum()-dists[1].sum())
+
+def test_feature_cache():
+    """The cache evicts the least recently used positions and
+    does not change the agents' actions"""
+    boards = random_boards(10, seed=4)
+    cache = feature_cache(max_size=3)
+    compute = lambda idx: get_features(boards[idx])
+    assert np.array_equal(cache.get_many([0, 1, 2], compute), get_features(boards[:3]))
+    cache.get_many([0], compute)
+    cache.get_many([3], compute)
+    assert list(cache.data.keys())==[2, 0, 3]
+    # the entries do not hold on to the batches they came from
+    assert all(value.base is None for value in cache.data.values())
+    assert cache.stats()['hits']==1 and cache.stats()['misses']==4
+
+    env, params = four_in_a_row(), default_params().to_list()
+    states = [s for s, a in random_games(3, seed=12) if a is not None]
+    for agent_fn in [heuristic_agent, BFS_agent]:
+        plain, cached = agent_fn(env, params, cache_size=0), agent_fn(env, params)
+        for k in range(2):
+            # new parameters keep the cached features
+            params[5+k] += .5
+            plain.load_params(params)
+            cached.load_params(params)
+            for i, state in enumerate(states):
+                plain.seed(i)
+                action = plain.get_action(state)
+                cached.seed(i)
+                assert cached.get_action(state)==action
+        assert cached.cache.stats()['hits']>0
+
+
+if __name__ == "__main__":
+    test_feature_counts_match_loops()
+    test_heuristic_many_matches_heuristic()
+    test_feature_subsets()
+    test_feature_deltas_match_recount()
+    test_pattern_table_matches_patterns()
+    test_center_value_matches_norms()
+    test_feature_cache()
+    print("All tests passed!")
@@ -1,104 +1,162 @@
+import pickle
 import numpy as np
 from utils.env_fn import four_in_a_row
-from utils.model import heuristic_agent, accelerated_heuristic, Node
-    
+from utils.model import heuristic_agent, accelerated_heuristic_agent, BFS_agent, default_params, random_stream
+from utils.data_fn import feature_db
+from utils.test_env import random_games
+
 from copy import deepcopy
 import time
 
-def test_model_equivalence():
-    """Test if accelerated_heuristic produces identical results to heuristic_agent"""
-    
-    # Initialize environment and both agents
+def test_model_equivalence(tmp_path, verbose=False):
+    """Test if accelerated_heuristic_agent produces identical results to heuristic_agent"""
+
+    # Initialize environment and both agents with the same parameters
     env = four_in_a_row()
-    old_agent = heuristic_agent(env)
-    new_agent = accelerated_heuristic(env)
-    
-    # Set same parameters for both agents
     params = [.05, .02, 2, .2, 1.2, .8, 1, .4, 3.5, 10]
-    old_agent.load_params(params)
-    new_agent.load_params(params)
-    
+    db_fname = f'{tmp_path}/features.db'
+    old_agent = heuristic_agent(env, params)
+    new_agent = accelerated_heuristic_agent(env, params, db_fname=db_fname)
+
     # Timing variables
     old_heuristic_time = 0
     new_heuristic_time = 0
     old_action_time = 0
     new_action_time = 0
-    
+
     def compare_heuristics(board, player_id):
         nonlocal old_heuristic_time, new_heuristic_time
-        
+
         state = (deepcopy(board), player_id)
-        old_agent.player_id = player_id
-        new_agent.player_id = player_id
-        old_agent.opponent_id = 1 - player_id
-        new_agent.opponent_id = 1 - player_id
-        
+        for agent in [old_agent, new_agent]:
+            agent.player_id = player_id
+            agent.opponent_id = 1 - player_id
+
         # Time old agent
-        np.random.seed(0)
+        old_agent.seed(0)
         start = time.perf_counter()
-        old_value = old_agent.heuristic(deepcopy(state), verbose=False)
+        old_value = old_agent.heuristic(deepcopy(state))
         old_heuristic_time += time.perf_counter() - start
-        
+
         # Time new agent
-        np.random.seed(0)
+        new_agent.seed(0)
         start = time.perf_counter()
-        new_value = new_agent.heuristic(deepcopy(state), verbose=False)
+        new_value = new_agent.heuristic(deepcopy(state))
         new_heuristic_time += time.perf_counter() - start
-        
+
         return np.isclose(old_value, new_value, rtol=1e-6)
-    
+
     def compare_actions(board, player_id):
         nonlocal old_action_time, new_action_time
-        
+
         state = (deepcopy(board), player_id)
-        
+
         # Time old agent
-        np.random.seed(0)
+        old_agent.seed(0)
         start = time.perf_counter()
         old_action = old_agent.get_action(deepcopy(state))
         old_action_time += time.perf_counter() - start
-        
+
         # Time new agent
-        np.random.seed(0)
+        new_agent.seed(0)
         start = time.perf_counter()
         new_action = new_agent.get_action(deepcopy(state))
         new_action_time += time.perf_counter() - start
-        
-        equal = old_action == new_action
-        if not equal:
-            print(f"\nActions differ: Old={old_action}, New={new_action}")
-        return equal
-    
-    # ... existing test_boards definition ...
-    
+
+        return old_action == new_action
+
+    # the positions of random games, that are not over
+    test_boards = [state[0] for state, action in random_games(10, seed=6) if action is not None]
+
     # Run tests
     total_tests = len(test_boards) * 2  # For both players
     for i, board in enumerate(test_boards):
         for player_id in [0, 1]:
-            heuristic_equal = compare_heuristics(board, player_id)
-            action_equal = compare_actions(board, player_id)
-            
-            if not (heuristic_equal and action_equal):
-                print(f"Test failed for board {i}, player {player_id}")
-                print(f"Heuristic equal: {heuristic_equal}")
-                print(f"Action equal: {action_equal}")
-                return False
-    
-    # Print timing results
-    print("\nTiming Results:")
-    print(f"Heuristic Evaluation:")
-    print(f"  Original: {old_heuristic_time:.6f} seconds total, {old_heuristic_time/total_tests:.6f} seconds per test")
-    print(f"  Accelerated: {new_heuristic_time:.6f} seconds total, {new_heuristic_time/total_tests:.6f} seconds per test")
-    print(f"  Speedup: {old_heuristic_time/new_heuristic_time:.2f}x")
-    
-    print(f"\nAction Selection:")
-    print(f"  Original: {old_action_time:.6f} seconds total, {old_action_time/total_tests:.6f} seconds per test")
-    print(f"  Accelerated: {new_action_time:.6f} seconds total, {new_action_time/total_tests:.6f} seconds per test")
-    print(f"  Speedup: {old_action_time/new_action_time:.2f}x")
-    
-    print("\nAll tests passed! Models are functionally equivalent.")
-    return True
+            assert compare_heuristics(board, player_id), f'heuristic differs on board {i}, player {player_id}'
+            assert compare_actions(board, player_id), f'action differs on board {i}, player {player_id}'
+
+    # a new agent, e.g. in another process, reads the features of the first
+    new_agent.flush()
+    stats = new_agent.cache.stats()
+    assert stats['misses']>0 and len(feature_db(db_fname))==stats['misses']
+    other_agent = pickle.loads(pickle.dumps(accelerated_heuristic_agent(env, params, db_fname=db_fname)))
+    other_agent.seed(0)
+    other_agent.get_action((test_boards[-1], 1))
+    assert other_agent.cache.stats()['misses']==0 and other_agent.cache.stats()['store_hits']>0
+
+    if verbose:
+        # Print timing results
+        print("\nTiming Results:")
+        print(f"Heuristic Evaluation:")
+        print(f"  Original: {old_heuristic_time:.6f} seconds total, {old_heuristic_time/total_tests:.6f} seconds per test")
+        print(f"  Accelerated: {new_heuristic_time:.6f} seconds total, {new_heuristic_time/total_tests:.6f} seconds per test")
+        print(f"  Speedup: {old_heuristic_time/new_heuristic_time:.2f}x")
+
+        print(f"\nAction Selection:")
+        print(f"  Original: {old_action_time:.6f} seconds total, {old_action_time/total_tests:.6f} seconds per test")
+        print(f"  Accelerated: {new_action_time:.6f} seconds total, {new_action_time/total_tests:.6f} seconds per test")
+        print(f"  Speedup: {old_action_time/new_action_time:.2f}x")
+        print(f"\nCache: {new_agent.cache.stats()}")
+
+        print("\nAll tests passed! Models are functionally equivalent.")
+
+def test_feature_db(tmp_path):
+    """The database returns the features put in it, across connections"""
+    fname = f'{tmp_path}/feature_db.db'
+    rng = np.random.default_rng(0)
+    keys = [int(k) for k in rng.integers(2**63, size=100, dtype=np.uint64)*2+1]
+    features = rng.normal(size=[len(keys), 2, 5])
+    db = feature_db(fname, flush_size=30)
+    db.put_many(keys[:50], features[:50])
+    # the rows are read as soon as they are put
+    assert len(db.get_many(keys[40:60]))==10
+    db.put_many(keys[50:], features[50:])
+    db.flush()
+    reader = pickle.loads(pickle.dumps(feature_db(fname)))
+    found = reader.get_many(keys+[2, 4])
+    assert len(found)==len(keys) and len(reader)==len(keys)
+    for key, value in zip(keys, features):
+        assert np.array_equal(found[key], value)
+
+def test_random_stream():
+    """The draws do not depend on the blocks, and an agent 
+    sent to another process repeats the same trials"""
+    stream, ref = random_stream(3, block_size=5), random_stream(3, block_size=5)
+    draws_main = [stream.normal() for _ in range(7)] + list(stream.normal(6)) + [stream.normal()]
+    assert np.array_equal(draws_main, ref.normal(14))
+    assert np.array_equal(stream.uniform(4), ref.uniform(4))
+    # spawned streams are independent
+    children = random_stream(3).spawn(2)
+    assert not np.allclose(children[0].normal(10), children[1].normal(10))
+    # a trial restarts its own stream, whatever was drawn before
+    seeds = stream.trial_seeds(2)
+    draws = []
+    for seed in seeds+seeds[:1]:
+        stream.reset(seed)
+        draws.append(np.concatenate([stream.normal(40), [stream.uniform()]]))
+        stream.normal(100)
+    assert np.array_equal(draws[0], draws[2]) and not np.allclose(draws[0], draws[1])
+    stream.reset()
+    assert np.array_equal(stream.normal(14), draws_main)
+
+    env, params = four_in_a_row(), default_params().to_list()
+    states = [state for state, action in random_games(2, seed=4) if action is not None]
+    agent = BFS_agent(env, params, seed=2025)
+    worker = pickle.loads(pickle.dumps(agent))
+    actions = []
+    for state, seed_seq in zip(states, agent.rng.trial_seeds(len(states))):
+        agent.rng.reset(seed_seq)
+        actions.append(agent.get_action(state))
+    # the second half of the trials, in the worker
+    seeds = worker.rng.trial_seeds(len(states))
+    for i in range(len(states)//2, len(states)):
+        worker.rng.reset(seeds[i])
+        assert worker.get_action(states[i])==actions[i]
 
 # Run the test
 if __name__ == "__main__":
-    test_model_equivalence() 
\ No newline at end of file
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_path:
+        test_model_equivalence(tmp_path, verbose=True)
+        test_feature_db(tmp_path)
+    test_random_stream()